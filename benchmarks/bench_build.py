@@ -0,0 +1,211 @@
+"""
+Flastik - A Flask-like Tiny-framework for static websites.
+(c) Copyright 2019-2026. See LICENSE for details.
+
+Benchmarks of the build hot paths on synthetic web sites.
+
+Generates a Flastik project of the requested scale in a temporary folder (a
+flat view and a deeply ramified one, StaticFiles and a large RST file), times
+each stage separately and saves the timings as JSON, so that two runs (e.g.
+before and after a change) can be compared.
+
+Usage:
+    python benchmarks/bench_build.py --scale 100k --output before.json
+    python benchmarks/bench_build.py --scale 100k --output after.json
+    python benchmarks/bench_build.py --compare before.json after.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import flastik
+from flastik import Builder, Image, collect_static_files, render_template, rst2html
+
+SCALES = {"1k": 1_000, "100k": 100_000, "1m": 1_000_000}
+
+TEMPLATES = {
+    "base.html": (
+        "<html><head><title>{{ title }}</title></head><body>"
+        "{% block content %}{% endblock %}</body></html>"
+    ),
+    "page.html": (
+        '{% extends "base.html" %}{% block content %}'
+        "<h1>{{ title }}</h1>"
+        '<a href="{{ url_for("flat", page=1) }}">first</a>'
+        "{% for item in items %}<p>{{ item }}</p>{% endfor %}"
+        "{% endblock %}"
+    ),
+}
+
+
+def ramification(pages):
+    """
+    Returns the variables of a four level route, alternating lists and dicts
+    of lists keyed on the previous variable, with about 'pages' pages.
+    """
+    width = max(2, round(pages ** 0.25))
+    sections = [f"s{i}" for i in range(width)]
+    chapters = {section: [f"{section}c{j}" for j in range(width)] for section in sections}
+    volumes = list(range(width))
+    issues = {volume: [f"v{volume}i{k}" for k in range(width)] for volume in volumes}
+    return {"section": sections, "chapter": chapters, "volume": volumes, "issue": issues}
+
+
+def make_project(root, statics, rst_kb):
+    """Writes the templates, static file sources and RST file of the project."""
+    templates = os.path.join(root, "templates")
+    os.makedirs(templates)
+    for name, source in TEMPLATES.items():
+        with open(os.path.join(templates, name), "w") as f:
+            f.write(source)
+    sources = os.path.join(root, "sources")
+    os.makedirs(sources)
+    for i in range(statics):
+        with open(os.path.join(sources, f"image_{i}.png"), "wb") as f:
+            f.write(i.to_bytes(8, "little") * 64)
+    paragraph = "Lorem *ipsum* dolor sit amet, ``consectetur`` adipiscing elit.\n\n"
+    rst_file = os.path.join(root, "large.rst")
+    with open(rst_file, "w") as f:
+        f.write("Title\n=====\n\n")
+        for i in range(rst_kb * 1024 // (len(paragraph) + 40)):
+            if i % 50 == 0:
+                title = f"Section {i}"
+                f.write(f"{title}\n{'-' * len(title)}\n\n")
+            f.write(paragraph)
+    return templates, sources, rst_file
+
+
+class Stages:
+    """Times the stages of a benchmark run."""
+
+    def __init__(self):
+        self.seconds = {}
+
+    @contextlib.contextmanager
+    def __call__(self, name):
+        print(f"{name}...", end=" ", file=sys.stderr, flush=True)
+        start = time.perf_counter()
+        yield
+        self.seconds[name] = time.perf_counter() - start
+        print(f"{self.seconds[name]:.3f}s", file=sys.stderr)
+
+
+def run(args):
+    pages = SCALES[args.scale]
+    stages = Stages()
+    with tempfile.TemporaryDirectory(dir=args.workdir) as root:
+        os.chdir(root)  # Note: the Builder's log file goes there
+        templates, sources, rst_file = make_project(root, args.statics, args.rst_kb)
+        website = Builder(template_dirs=[templates])
+        flat_pages = pages // 2
+        deep_vars = ramification(pages - flat_pages)
+
+        with stages("route"):
+
+            @website.route("/flat/<int:page>/", page=list(range(flat_pages)))
+            def flat(page):
+                return render_template("page.html", title=f"Page {page}", items=range(10))
+
+            @website.route(
+                "/deep/<string:section>/<string:chapter>/<int:volume>/<string:issue>/",
+                **deep_vars,
+            )
+            def deep(section, chapter, volume, issue):
+                return render_template("page.html", title=issue, items=(section, chapter))
+
+        with stages("generate_route_vars"):
+            found = [("string", "section"), ("string", "chapter"), ("int", "volume"),
+                     ("string", "issue")]
+            route_vars = website._generate_route_vars(found, deep_vars, "/deep/")
+        with stages("expand_route_vars"):
+            expanded = sum(1 for _ in route_vars)
+
+        with stages("url_for"):
+            for page in range(min(pages, 100_000)):
+                website.current_route = f"flat/{page % 1000}"
+                website.url_for("flat", page=page)
+            website.current_route = None
+
+        with stages("static_files"):
+            for i in range(args.statics):
+                Image(f"image_{i}", os.path.join(sources, f"image_{i}.png"))
+
+        with stages("rst2html"):
+            rst2html(rst_file)
+
+        dest = os.path.join(root, "site")
+        quiet = contextlib.redirect_stdout(io.StringIO())
+        with stages("build"), quiet:
+            website.build(dest=dest, jobs=args.jobs, writers=args.writers)
+        with stages("build_incremental_first"), quiet:
+            website.build(dest=dest, jobs=args.jobs, writers=args.writers, incremental=True)
+        with stages("build_incremental_unchanged"), quiet:
+            website.build(dest=dest, jobs=args.jobs, writers=args.writers, incremental=True)
+        with stages("collect_static_files"), quiet:
+            collect_static_files(builder=website, copy_locally=True, writers=args.writers)
+        with stages("collect_static_files_unchanged"), quiet:
+            collect_static_files(builder=website, copy_locally=True, writers=args.writers)
+
+    return {
+        "flastik": flastik.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "parameters": {
+            "scale": args.scale,
+            "pages": flat_pages + expanded,
+            "statics": args.statics,
+            "rst_kb": args.rst_kb,
+            "jobs": args.jobs,
+            "writers": args.writers,
+        },
+        "seconds": stages.seconds,
+    }
+
+
+def compare(before, after):
+    """Prints the change of each stage's duration between two runs."""
+    with open(before) as f:
+        before = json.load(f)["seconds"]
+    with open(after) as f:
+        after = json.load(f)["seconds"]
+    print(f"{'stage':32} {'before':>10} {'after':>10} {'change':>8}")
+    for stage in [stage for stage in before if stage in after]:
+        change = (after[stage] - before[stage]) / before[stage] if before[stage] else 0.0
+        print(f"{stage:32} {before[stage]:10.3f} {after[stage]:10.3f} {change:+8.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--scale", choices=sorted(SCALES), default="1k",
+                        help="number of pages of the web site")
+    parser.add_argument("--statics", type=int, default=1000, help="number of StaticFiles")
+    parser.add_argument("--rst_kb", type=int, default=256, help="size of the RST file, in KiB")
+    parser.add_argument("--jobs", type=int, default=1, help="processes rendering the pages")
+    parser.add_argument("--writers", type=int, default=4, help="threads writing the files")
+    parser.add_argument("--workdir", help="folder the project is generated in (default: /tmp)")
+    parser.add_argument("--output", help="path to the JSON results (default: stdout)")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"),
+                        help="compare two JSON results instead of running")
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+        return
+    if args.output:
+        args.output = os.path.abspath(args.output)
+    results = json.dumps(run(args), indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(results + "\n")
+    else:
+        print(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -15,6 +15,7 @@ from .flastik import (
     Download,
     FlastikError,
     Image,
+    RouteVars,
     StaticFile,
     add_build_arguments,
     add_Builder_arguments,
@@ -25,6 +26,7 @@ from .flastik import (
     collect_static_files,
     render_template,
     rst2html,
+    stream_template,
 )
 
 __all__ = [
@@ -32,6 +34,7 @@ __all__ = [
     "Download",
     "FlastikError",
     "Image",
+    "RouteVars",
     "StaticFile",
     "add_Builder_arguments",
     "add_build_arguments",
@@ -42,5 +45,6 @@ __all__ = [
     "collect_static_files",
     "render_template",
     "rst2html",
+    "stream_template",
 ]
 
@@ -234,8 +234,12 @@ if __name__ == "__main__":
 
 
     # Building Website and collecting statics
-    website.build(**options)
-    collect_static_files(**options)
+    if options["watch"]:
+        website.watch(**options)
+    else:
+        website.build(**options)
+        if not options["output"]:  # Note: archives hold the static files
+            collect_static_files(**options)
 """
 
 if __name__ == "__main__":
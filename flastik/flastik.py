@@ -4,22 +4,63 @@ Flastik - A Flask-like Tiny-framework for static websites.
 """
 
 # Imports
+import filecmp
+import fnmatch
+import gzip
+import hashlib
+import heapq
 import itertools
+import json
 import logging
+import math
+import mimetypes
+import multiprocessing
 import os
+import queue
 import re
 import shutil
 import sys
+import tarfile
+import tempfile
+import threading
+import time
+import traceback
+import types
+import zipfile
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
 from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from stat import S_IFDIR, S_IFREG, S_IMODE, S_ISLNK, S_ISREG
 from typing import ClassVar
+from urllib.parse import unquote, urlsplit
 from uuid import uuid4
 
+import docutils
 from docutils.core import publish_parts
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
 # Standard logging
 log = logging.getLogger(__name__)
 
+# What, besides its content, the html docutils makes of an RST file depends on
+_RST_SETTINGS = json.dumps({"docutils": docutils.__version__, "writer": "html5"})
+
+# Extensions of the files worth precompressing (see Builder.build)
+_COMPRESSIBLE = {
+    ".html", ".htm", ".css", ".js", ".mjs", ".map", ".json", ".xml", ".svg",
+    ".txt", ".csv", ".md", ".rst",
+}
+
+# ioctl request cloning a file, on file systems sharing blocks (Linux)
+_FICLONE = 0x40049409
+
 
 class FlastikError(Exception):
     """
@@ -30,9 +71,45 @@ class FlastikError(Exception):
     """
 
 
+class _Environment(Environment):
+    """
+    Jinja environment reporting every template it hands out to its Builder,
+    including the ones pulled in by {% extends %}, {% include %} and
+    {% import %} tags, so that the Builder knows which templates each page
+    depends on, as well as the time spent compiling templates.
+    """
+
+    def __init__(self, builder, **options):
+        super().__init__(**options)
+        self.builder = builder
+
+    def get_template(self, name, parent=None, globals=None):
+        template = super().get_template(name, parent=parent, globals=globals)
+        self.builder._depends_on(template.filename)
+        return template
+
+    def select_template(self, names, parent=None, globals=None):
+        template = super().select_template(names, parent=parent, globals=globals)
+        self.builder._depends_on(template.filename)
+        return template
+
+    def compile(self, source, name=None, filename=None, raw=False, defer_init=False):
+        # Note: templates loaded from the bytecode cache are not compiled
+        start = time.perf_counter()
+        try:
+            return super().compile(source, name, filename, raw, defer_init)
+        finally:
+            self.builder._compile_time += time.perf_counter() - start
+
+
 class Builder:
     instance: ClassVar[list] = []
     _rendering = None
+    # Maximum number of relative urls cached, see _relative_url
+    url_cache_max_size = 100_000
+    # Maximum number of RST conversions, and of templates compiled from
+    # them, kept in memory, see rst2html
+    rst_cache_max_size = 1024
 
     def __init__(
         self,
@@ -45,6 +122,8 @@ class Builder:
         description=None,
         author=None,
         log_level="ERROR",
+        template_cache_dir=None,
+        rst_cache_dir=None,
         **kwargs,
     ):
         """
@@ -87,6 +166,17 @@ class Builder:
 
             log_level: logging level, str. ('CRITICAL', 'ERROR', 'WARNING',
                 'INFO' or 'DEBUG')
+
+            template_cache_dir: path to a folder caching compiled templates, str.
+                If None (default): templates are compiled by every process.
+                Otherwise: compiled templates are kept in that folder and
+                    reused by later processes as long as neither their
+                    source nor the template search path change.
+            rst_cache_dir: path to a folder caching RST conversions, str.
+                If None (default): RST files are converted by every process.
+                Otherwise: the html docutils makes of an RST file is kept in
+                    that folder and reused by later processes as long as
+                    neither the RST content nor docutils change.
         """
         # Environment
         # - Logging scheme
@@ -108,8 +198,34 @@ class Builder:
             log.addHandler(logging.StreamHandler(sys.stdout))
         log_handler.setFormatter(log_format)
         self.web_pages = {}
-        self.routes = []
+        self.routes = _RouteRegistry()
         self.current_route = None
+        # - Files the page being rendered depends on (see _depends_on)
+        self._page_dependencies = None
+        # - Seconds spent compiling templates for the page being rendered, and
+        #   report and files changed by the build in progress (see build)
+        self._compile_time = 0.0
+        self._report = None
+        self._changes = None
+        # - Dependency graph: page -> (view, route vars., files) and its
+        #   reverse index: file -> pages (see dependencies)
+        self._dependencies = {}
+        self._dependents = {}
+        # - Relative urls resolved so far: (current route, path) -> url
+        self._url_cache = {}
+        self._url_cache_hits = 0
+        self._url_cache_misses = 0
+        # - RST conversions: cache folder, and templates compiled from
+        #   converted RST, least recently used first (see rst2html)
+        self.rst_cache_dir = rst_cache_dir
+        if rst_cache_dir:
+            os.makedirs(rst_cache_dir, exist_ok=True)
+        self._rst_templates = OrderedDict()
+        # - Html of the RST conversions made so far, content key -> html,
+        #   least recently used first, and number of them preloaded (kept
+        #   for the build whatever rst_cache_max_size, see preload_rst)
+        self._rst_html = OrderedDict()
+        self._rst_preloaded = 0
         # - Register as the current Builder
         Builder.instance.append(self)
         # - Backend attributes
@@ -135,8 +251,10 @@ class Builder:
             Or/and provide a valid path to templates via the 'templates' option."""
             log.error(msg)
             raise FlastikError(msg)
-        self.jinja_env = Environment(
+        self.jinja_env = _Environment(
+            self,
             loader=loader,
+            bytecode_cache=self._make_bytecode_cache(template_cache_dir, loader),
             # Note: autoescape stops you from injecting str into template
             #       as in the html_image method for instance
             # autoescape=select_autoescape(['html', 'xml'])
@@ -160,6 +278,11 @@ class Builder:
             self.favicon = os.path.join(
                 self.package_path, "base_templates/default_icon.png"
             )
+        # - Sources of the files copied to 'static'
+        #   Note: build() points css_style_sheet and favicon to their copies,
+        #         later builds must still copy from the sources.
+        self._css_source = self.css_style_sheet
+        self._favicon_source = self.favicon
 
     def route(self, route, _func=None, **kwargs_deco):
         """
@@ -236,24 +359,35 @@ class Builder:
         if found:
             log.debug(f"Generating Route: {route_pattern} ; Vars.: {route_vars}")
             route_vars = self._generate_route_vars(found, kwargs_deco, route)
-        # - check if routes already in use, if not store them
-        for vv in route_vars:
-            new_pattern = route_pattern % vv
-            new_route = os.path.join(new_pattern, html_name)
-            log.debug(new_route)
-            # - check if route is url and system file friendly
-            check_url_for_unsafe_characters(new_pattern)
-            check_path_for_illegal_characters(new_pattern)
-            if new_route not in self.routes:
-                self.routes.append(new_route)
-                log.info("New route: %s", new_route)
-            else:
-                msg = (
-                    "Change route pattern and/or variables: "
-                    f"{new_route} already used by another view"
-                )
-                log.error(msg)
-                raise FlastikError(msg)
+        # Note: completed with the view by the wrapper below
+        page = {
+            "route_pattern": route_pattern,
+            "html_name": html_name,
+            "key_args": key_args,
+            "route_vars": route_vars,
+        }
+        self._url_cache.clear()
+        # - check if routes are url and system file friendly, and not already
+        #   in use, then store them
+        # Note: the routes are made of the pattern and of the variables'
+        #       values, which are checked once each rather than per route
+        if route_vars:
+            check_url_for_unsafe_characters(route_pattern.replace("%s", ""))
+            check_path_for_illegal_characters(route_pattern.replace("%s", ""))
+            for var_name, level in zip(key_args, route_vars.levels, strict=True):
+                for values in level.values() if isinstance(level, dict) else [level]:
+                    texts = [str(value) for value in values]
+                    for text in texts:
+                        check_url_for_unsafe_characters(text)
+                        check_path_for_illegal_characters(text)
+                    if len(set(texts)) != len(texts):
+                        msg = (
+                            "Change route pattern and/or variables: values of "
+                            f"{var_name} {values} would make the same routes"
+                        )
+                        log.error(msg)
+                        raise FlastikError(msg)
+        self._add_route(page, [var_type for var_type, _ in found])
 
         def wrapper(func):
             @wraps(func)
@@ -294,13 +428,9 @@ class Builder:
                 msg = f"'{func.__name__}' is already used for another view function"
                 log.error(msg)
                 raise FlastikError(msg)
-            self.web_pages[func.__name__] = {
-                "route_pattern": route_pattern,
-                "html_name": html_name,
-                "key_args": key_args,
-                "route_vars": route_vars,
-                "view": func,
-            }
+            page["view"] = func
+            page["name"] = func.__name__
+            self.web_pages[func.__name__] = page
             log.debug(
                 "Storing %s view parameters: /n%s",
                 func.__name__,
@@ -316,6 +446,25 @@ class Builder:
         #     return wrapper(_func)
         return wrapper
 
+    def _add_route(self, page, var_types):
+        """
+        Registers the routes of a view, making sure no other view uses them
+
+        Args:
+            page: view parameters, as stored in web_pages, dict.
+            var_types: types of the route variables, in route order, [str.,...]
+        """
+        used = self.routes.collision(page, var_types)
+        if used is not None:
+            msg = (
+                "Change route pattern and/or variables: "
+                f"{used} already used by another view"
+            )
+            log.error(msg)
+            raise FlastikError(msg)
+        self.routes.add(page, var_types)
+        log.info("New route: %s", os.path.join(page["route_pattern"], page["html_name"]))
+
     def url_for(self, name, **kwargs):
         """
         Flask-lookalike templating function.
@@ -361,11 +510,45 @@ class Builder:
             # TODO: Do I wan to raise here and make it less permissive?
             return None
         # - make relative path to where it got called
-        log.debug("current route: %s ", self.current_route)
-        relative_path = os.path.relpath(path, self.current_route)
+        relative_path = self._relative_url(path)
         log.debug("relative path: %s", relative_path)
         return relative_path
 
+    def url_cache_info(self):
+        """
+        Returns the statistics of the cache behind url_for and StaticFile.url,
+        which resolve each path relatively to the page being rendered only
+        once per page route.
+
+        Returns: dict with 'hits', 'misses' and 'size' (number of cached urls)
+        """
+        return {
+            "hits": self._url_cache_hits,
+            "misses": self._url_cache_misses,
+            "size": len(self._url_cache),
+        }
+
+    def _relative_url(self, path):
+        """
+        Returns the path relative to the route being rendered, memoized.
+
+        Args:
+            path: path relative to the web site root, str.
+
+        Returns: relative path, str.
+        """
+        key = (self.current_route, path)
+        relative_path = self._url_cache.get(key)
+        if relative_path is not None:
+            self._url_cache_hits += 1
+            return relative_path
+        self._url_cache_misses += 1
+        if len(self._url_cache) >= self.url_cache_max_size:
+            self._url_cache.clear()
+        relative_path = os.path.relpath(path, self.current_route)
+        self._url_cache[key] = relative_path
+        return relative_path
+
     def build(
         self,
         dest=None,
@@ -374,6 +557,19 @@ class Builder:
         static_umask=0o655,
         html_umask=0o644,
         dir_umask=0o755,
+        jobs=1,
+        writers=4,
+        incremental=False,
+        changed=None,
+        report=None,
+        report_slowest=20,
+        minify=False,
+        precompress=False,
+        precompress_min_size=1024,
+        output=None,
+        change_set=None,
+        routes=None,
+        where=None,
         **kwargs,
     ):
         """
@@ -390,6 +586,24 @@ class Builder:
             views: list of views to be built, [str.,...,str.]
                 Note: All views are built by default.
 
+            routes: glob patterns of the pages to be built, [str.,...,str.]
+                If None (default): every page of the views is built.
+                Otherwise: only the pages whose route (e.g.
+                    "cruise/2021/leg_1/index.html") or folder (e.g.
+                    "cruise/2021/leg_1") matches one of the patterns are.
+                    Ex.: ["cruise/2021/*"]
+
+            where: values of route variables the pages to be built take,
+                {name: [value,...,value]} dict, or ["name=value",...] list.
+                If None (default): every page of the views is built.
+                Otherwise: only the pages of views having these variables,
+                    and taking one of these values for each of them, are.
+                    Values are compared as they appear in urls, i.e. as str.
+                    An empty list of values selects no page.
+                    Ex.: {"year": [2021]}
+                Note: pages which are not built are not removed, and links to
+                      them (see url_for) are made as usual.
+
             overwrite: boolean switch, bool.
                 If True (default): pre-existing *.html files and Bootstrap
                     suite will be overwritten.
@@ -402,9 +616,95 @@ class Builder:
 
             dir_umask: U-mask for directories, U-mask code
                 Default value: 0o755, Operating-system mode bitfield.
+
+            jobs: number of processes rendering the pages, int.
+                If 1 (default): pages are rendered one after the other.
+                If None or 0: one process per CPU is used.
+                Note: parallel rendering requires the 'fork' start method,
+                      and views must not depend on the order in which pages
+                      are rendered (e.g. through a shared, mutated context).
+
+            writers: number of threads writing the *.html files, int.
+                Default value: 4. Pages are handed over to them through a
+                bounded queue, so that rendering carries on while earlier
+                pages are being written. If 0: pages are written as soon as
+                they are rendered.
+
+            incremental: boolean switch, bool.
+                If False (default): every page is rendered.
+                If True: a manifest of the pages built is kept in
+                    dest/.flastik/manifest.json, and pages whose view code,
+                    route variables, meta and templates are unchanged since
+                    the previous incremental build are not rendered again.
+                    Pages of routes which no longer exist are deleted.
+                Note: data read by the views themselves (files, databases)
+                      is not tracked. Run a full build when it changes.
+
+            changed: paths to files which changed since the last build, list.
+                If None (default): all pages are built.
+                Otherwise: only the pages depending on these files, i.e. the
+                    pages which loaded these templates, converted these RST
+                    files or used the url of these static files when last
+                    built, are rendered (see dependencies). Pages never built
+                    before are rendered too.
+
+            report: path to a build report, str.
+                If None (default): no report is made.
+                Otherwise: the render time (total, mean and 95th
+                    percentile), write time, bytes written and template
+                    compile time of each view's pages, as well as the
+                    slowest pages, are saved there as JSON, and next to it
+                    (with a '.prom' extension) as a Prometheus text file.
+
+            report_slowest: number of slowest pages listed in the report, int.
+
+            minify: boolean switch, bool.
+                If False (default): pages and style sheet are written as is.
+                If True: whitespace runs and comments are squeezed out of the
+                    pages (leaving <pre>, <textarea>, <script> and <style>
+                    elements untouched), and out of the style sheet. Streamed
+                    pages are not minified. In incremental and changed
+                    builds, pages whose html is the same as at the last
+                    build are neither minified nor written again.
+
+            precompress: boolean switch, bool.
+                If False (default): only the files themselves are written.
+                If True: a gzip compressed copy (e.g. index.html.gz) is
+                    written next to each page and Bootstrap, style sheet or
+                    other text file of the 'static' folder, for web servers
+                    serving precompressed files (e.g. nginx's gzip_static).
+                    Copies are only written when compression makes the file
+                    smaller, and only made again when the file changed.
+
+            precompress_min_size: files smaller than this number of bytes
+                are not compressed, int. Default value: 1024.
+
+            output: path to an archive of the web site, str.
+                If None (default): the web site is written to dest.
+                Otherwise: pages, Bootstrap suite, style sheet, favicon and
+                    the Builder's static files are streamed into that archive
+                    instead (.zip, .tar, .tar.gz, .tgz, .tar.bz2, .tar.xz, or
+                    .tar.zst which requires the 'zstandard' package), with
+                    the umasks as member modes and dest as its root.
+                    Nothing is written to dest, so collect_static_files is
+                    not needed. Not compatible with incremental, changed or
+                    precompress.
+
+            change_set: path to a JSON file, str.
+                If None (default): the change set is only returned.
+                Otherwise: it is also saved there.
+
+        Returns: change set of the build, that is the pages and files of the
+            'static' folder (and of the static files, when building an
+            archive) which were added, modified or removed, as paths relative
+            to dest: {"added": [...], "modified": [...], "removed": [...]}
+            Note: pages and files whose content did not change are left
+                  untouched, modification time included.
         """
+        build_start = time.perf_counter()
         # New attributes...not compliant with PEP but whatever
         self.overwrite = overwrite
+        self.minify = minify
         if isinstance(static_umask, str):
             log.debug("static_umask as str: %s", static_umask)
             static_umask = int(static_umask, 8)
@@ -418,147 +718,248 @@ class Builder:
             html_umask = int(html_umask, 8)
         self.html_umask = html_umask
         # Sanity checks
+        if output is not None and (incremental or changed is not None or precompress):
+            msg = "An archive output is not compatible with incremental, changed or precompress."
+            log.error(msg)
+            raise FlastikError(msg)
         if dest is None:
-            self.dest = os.path.join(os.getcwd(), "build")
+            dest = os.path.join(os.getcwd(), "build")
+        self.dest = dest
+        if output is None:
+            self.fs = _FileSystem(dir_umask, html_umask)
+            self.fs.makedirs(dest)
+            log.info("Website destination: %s", self.dest)
         else:
-            if not os.path.isdir(dest):
-                os.makedirs(dest, dir_umask)
-            self.dest = dest
-        log.info("Website destination: %s", self.dest)
+            self.fs = _ArchiveSink(output, dest, dir_umask, html_umask)
+            log.info("Website archive: %s", output)
+        self._changes = _ChangeSet(dest)
+        try:
+            self._build(
+                build_start,
+                views=views,
+                jobs=jobs,
+                writers=writers,
+                incremental=incremental,
+                changed=changed,
+                report=report,
+                report_slowest=report_slowest,
+                minify=minify,
+                precompress=precompress,
+                precompress_min_size=precompress_min_size,
+                routes=routes,
+                where=where,
+                **kwargs,
+            )
+        except BaseException:
+            if output is not None:
+                self.fs.close(discard=True)
+            raise
+        if output is not None:
+            self.fs.close()
+        changes = self._changes.summary()
+        if change_set is not None:
+            self._changes.save(change_set)
+        log.info(
+            "%s files added, %s modified, %s removed",
+            *(len(paths) for paths in changes.values()),
+        )
+        return changes
+
+    def _build(
+        self,
+        build_start,
+        views,
+        jobs,
+        writers,
+        incremental,
+        changed,
+        report,
+        report_slowest,
+        minify,
+        precompress,
+        precompress_min_size,
+        routes,
+        where,
+        file_umask=0o644,
+        **kwargs,
+    ):
+        """Builds the static website project once its destination is set (see build)"""
         if views is None:
             views = []
         elif not isinstance(views, list):
             views = [views]
         if not views:
             views = self.web_pages.keys()
+        selection = None
+        if routes or where:
+            selection = self._select_pages(views, routes, where)
+            views = list(selection)
         page_count = sum(
-            len(self.web_pages[name]["route_vars"]) if self.web_pages[name]["route_vars"] else 1
+            len(selection[name]) if selection is not None and selection[name] is not None
+            else len(self.web_pages[name]["route_vars"]) if self.web_pages[name]["route_vars"]
+            else 1
             for name in views
         )
         total = 2 * page_count
         done = 0
         # Building static website:
         # - Make website dirs
-        for name in views:
+        for name, vv in self._iter_pages(views, selection):
             route_pattern = self.web_pages[name]["route_pattern"]
-            route_vars = self.web_pages[name]["route_vars"]
-            if not route_vars:
-                full_paths = [os.path.join(self.dest, route_pattern)]
-            else:
-                full_paths = []
-                for vv in route_vars:
-                    full_paths.append(os.path.join(self.dest, route_pattern % vv))
-            for full_path in full_paths:
-                if not os.path.exists(full_path):
-                    if isinstance(self.dir_umask, str):
-                        self.dir_umask = int(self.dir_umask, 8)
-                    os.makedirs(full_path, self.dir_umask)
-                    log.debug("Making %s", full_path)
-                done += 1
-                self._report_progress(done, total)
+            full_path = os.path.join(self.dest, route_pattern % vv if vv else route_pattern)
+            self.fs.makedirs(full_path)
+            done += 1
+            self._report_progress(done, total)
         # - Make 'static' folder & move static files where they belong
+        # Note: files are only written when their content differs from what
+        #       is already deployed, and their permissions set as they are.
         self.static_path = os.path.join(self.dest, "static")
-        if not os.path.exists(self.static_path):
-            os.makedirs(self.static_path)
-            log.debug("Making %s", self.static_path)
+        self.fs.makedirs(self.static_path)
+        self.fs.chmod(self.static_path, self.dir_umask)
         # - Copy bootstrap
         if self.copy_bootstrap:
             if not os.path.exists(self.bootstrap_folder):
                 msg = f"'{self.bootstrap_folder}' does not exist."
                 log.error(msg)
                 raise FlastikError(msg)
-            for ff in os.listdir(self.bootstrap_folder):
-                orig = os.path.join(self.bootstrap_folder, ff)
-                dest = os.path.join(self.static_path, ff)
-                if os.path.isfile(orig):
-                    if os.path.exists(dest) and not self.overwrite:
-                        continue
-                    else:
-                        shutil.copy(orig, dest)
-                        log.debug("Copying %s to %s", orig, dest)
-                elif os.path.isdir(orig):
-                    try:
-                        shutil.copytree(orig, dest)
-                    except FileExistsError:
-                        if self.overwrite:  # force overwriting
-                            shutil.rmtree(dest)
-                            shutil.copytree(orig, dest)
-                            log.debug("Copying %s to %s", orig, dest)
-                        else:
-                            raise
+            self._sync_static_tree(self.bootstrap_folder, self.static_path, mirror=False)
         # - Copy CSS style sheet
-        if not os.path.exists(self.css_style_sheet):
-            msg = f"'{self.css_style_sheet}' does not exist."
+        if not os.path.exists(self._css_source):
+            msg = f"'{self._css_source}' does not exist."
             log.error(msg)
             raise FlastikError(msg)
         dest = os.path.join(self.static_path, "stylesheet.css")
-        if os.path.exists(dest) and not self.overwrite:
-            pass
-        else:
-            try:
-                shutil.copy(self.css_style_sheet, dest)
-                log.info("Copying %s to %s", self.css_style_sheet, dest)
-            except shutil.SameFileError:
-                log.error(
-                    "Excepted SameFileError: '%s' and '%s' are the same file",
-                    self.css_style_sheet,
-                    dest,
-                )
+        self._sync_static_file(
+            self._css_source, dest, _minify_css if minify else None
+        )
         self.css_style_sheet = dest
         # - Copy favicon.ico
-        if not os.path.exists(self.favicon):
-            msg = f"'{self.favicon}' does not exist."
+        if not os.path.exists(self._favicon_source):
+            msg = f"'{self._favicon_source}' does not exist."
             log.error(msg)
             raise FlastikError(msg)
         dest = os.path.join(self.static_path, "favicon.ico")
-        if os.path.exists(dest) and not self.overwrite:
-            pass
-        else:
-            try:
-                shutil.copy(self.favicon, dest)
-                log.info("Copying %s to %s", self.favicon, dest)
-            except shutil.SameFileError:
-                log.error(
-                    "Excepted SameFileError: '%s' and '%s' are the same file",
-                    self.favicon,
-                    dest,
-                )
+        self._sync_static_file(self._favicon_source, dest)
         self.favicon = dest
 
-        # - Apply umasks to static
-        apply_umasks(self.static_path, self.dir_umask, self.static_umask)
-
         # - Render Templates
+        manifest = None
+        if incremental or changed is not None:
+            manifest = _BuildManifest(self)
+            self._load_dependencies(manifest)
+        affected = None if changed is None else self._pages_affected_by(changed)
+
+        # Note: pages are selected as they are rendered rather than up front,
+        #       and the ones left out count as done.
+        def selected_pages():
+            nonlocal done
+            for name, vv in self._iter_pages(views, selection):
+                if affected is not None:
+                    key = self._page_key(name, vv)
+                    if key in self._dependencies and key not in affected:
+                        done += 1
+                        self._report_progress(done, total)
+                        continue
+                if incremental and manifest.is_up_to_date(name, vv):
+                    done += 1
+                    self._report_progress(done, total)
+                    continue
+                yield name, vv
+
         # Note: the views are about to call render_template(), which binds to
         #       the current Builder. Make that this one for the duration of
         #       the build, in case another Builder has been created since.
         previously_rendering = Builder._rendering
         Builder._rendering = self
+        self._report = None if report is None else _BuildReport(report_slowest)
         try:
-            for name in views:
-                route_pattern = self.web_pages[name]["route_pattern"]
-                route_vars = self.web_pages[name]["route_vars"]
-                html_name = self.web_pages[name]["html_name"]
-                view = self.web_pages[name]["view"]
-                if not route_vars:
-                    route = route_pattern
-                    self.current_route = route
-                    rendered_html = view()
-                    log.info("Writting %s at %s/%s", html_name, self.dest, route)
-                    self._write_html_file(html_name, route, rendered_html)
+            with _PageWriter(self._write_page, writers) as writer:
+                for (name, vv), rendered in self._render_pages(
+                    selected_pages(), jobs, page_count
+                ):
+                    route, html_name, rendered_html, dependencies, timings = rendered
+                    key = os.path.join(route, html_name)
+                    # Note: minified pages whose rendered html did not change
+                    #       since the last build are neither minified nor
+                    #       written again (incremental and changed builds
+                    #       only, as this takes the last build's manifest)
+                    raw_digest = None
+                    if minify and isinstance(rendered_html, str):
+                        raw_digest = hashlib.sha1(rendered_html.encode()).hexdigest()
+                    if isinstance(rendered_html, int):  # Streamed, already written
+                        if self._report is not None:
+                            self._report.add_write(name, 0.0, rendered_html)
+                    elif manifest is not None and manifest.has_output(key, raw_digest):
+                        log.info("%s is unchanged", key)
+                    else:
+                        log.info("Writting %s at %s/%s", html_name, self.dest, route)
+                        writer.submit(key, name, html_name, route, rendered_html)
+                    if self._report is not None:
+                        self._report.add_render(name, vv, route, html_name, *timings)
+                    self._record_dependencies(name, vv, dependencies)
+                    if manifest is not None:
+                        manifest.record(name, vv, dependencies, raw_digest)
                     done += 1
                     self._report_progress(done, total)
-                else:
-                    for vv in route_vars:
-                        route = route_pattern % vv
-                        self.current_route = route
-                        rendered_html = view(*vv)
-                        log.info("Writting %s at %s/%s", html_name, self.dest, route)
-                        self._write_html_file(html_name, route, rendered_html)
-                        done += 1
-                        self._report_progress(done, total)
         finally:
             Builder._rendering = previously_rendering
+            build_report, self._report = self._report, None
+        if done < total:
+            self._report_progress(total, total)
+        # - Archive the static files, which collect_static_files would deploy
+        if not self.fs.shared:
+            if isinstance(file_umask, str):
+                file_umask = int(file_umask, 8)
+            for record in StaticFile.storage.of(self):
+                dest = os.path.join(self.dest, record.type, record.destination)
+                self.fs.makedirs(os.path.dirname(dest))
+                self.fs.copy(record.source, dest, file_umask)
+                self._changes.add("added", dest)
+        # - Remove the pages of routes which no longer exist
+        if incremental:
+            for page in manifest.remove_stale_pages():
+                self._forget_dependencies(page)
+                self._changes.add("removed", os.path.join(self.dest, page))
+                log.info("Removed %s", page)
+        if incremental or (manifest is not None and manifest.exists):
+            manifest.save()
+        # - Precompress pages and static files
+        if precompress:
+            pages = (
+                os.path.join(self.dest, self._page_key(name, vv))
+                for name, vv in self._iter_pages(views, selection)
+            )
+            static_files = (
+                os.path.join(root, f)
+                for root, _, files in os.walk(self.static_path)
+                for f in files
+            )
+            compressed = _precompress(
+                itertools.chain(pages, static_files), precompress_min_size
+            )
+            log.info("Compressed %s files", compressed)
+        if build_report is not None:
+            build_report.save(report, time.perf_counter() - build_start)
+
+    def dependencies(self, path=None):
+        """
+        Returns the dependency graph of the pages built so far, that is the
+        templates (including the ones pulled in by {% extends %} and
+        {% include %}), RST files and static file sources each page used
+        when it was last rendered.
+
+        Keyword Args:
+            path: path to a file, str.
+                If None (default): the whole graph is returned.
+                Otherwise: only the pages depending on that file are.
+
+        Returns: {page: [file,...,file]} dict, pages being paths relative to
+            the web site root and files absolute paths. [page,...,page] list
+            if 'path' is given.
+        """
+        if path is not None:
+            return sorted(self._dependents.get(os.path.abspath(path), ()))
+        return {page: list(entry[2]) for page, entry in self._dependencies.items()}
 
     @staticmethod
     def _report_progress(done, total, width=30):
@@ -689,6 +1090,148 @@ class Builder:
         return FileSystemLoader(search_path)
 
 
+    @staticmethod
+    def _make_bytecode_cache(template_cache_dir, loader):
+        """
+        Returns a bytecode cache storing compiled templates in a folder, None
+        if no folder is given.
+
+        Note: Jinja discards cached bytecode whose template source changed.
+              Caches are further kept apart per template search path, since
+              the same template name may then resolve to another file.
+        """
+        if not template_cache_dir:
+            return None
+        os.makedirs(template_cache_dir, exist_ok=True)
+        search_path = [os.path.abspath(path) for path in loader.searchpath]
+        digest = hashlib.sha1("\0".join(search_path).encode()).hexdigest()[:12]
+        return FileSystemBytecodeCache(
+            template_cache_dir, pattern=f"__flastik_{digest}_%s.cache"
+        )
+
+    def preload_rst(self, paths, jobs=None):
+        """
+        Converts RST files across a pool of processes ahead of rendering, so
+        that rst2html only has to render them with the views' context.
+
+        Args:
+            paths: path to a folder, searched recursively for *.rst files,
+                or paths to RST files, str. or [str.,...,str.]
+
+        Keyword Args:
+            jobs: number of processes, int. None or 0 (default) for one per CPU.
+
+        Returns: number of RST files converted, int. Files already converted
+            (in memory or in the rst_cache_dir) are not converted again.
+
+        Note: the preloaded conversions are all kept in memory, even past
+              rst_cache_max_size.
+        """
+        if isinstance(paths, str):
+            if os.path.isdir(paths):
+                paths = sorted(
+                    os.path.join(root, f)
+                    for root, _, files in os.walk(paths)
+                    for f in files
+                    if f.endswith(".rst")
+                )
+            else:
+                paths = [paths]
+        pending = {}
+        for path in paths:
+            with open(path) as f:
+                rst_string = f.read()
+            key = _rst_key(rst_string)
+            if key in self._rst_html or key in pending:
+                continue
+            self._rst_preloaded += 1
+            html_string = self._read_rst_cache(key)
+            if html_string is None:
+                pending[key] = rst_string
+            else:
+                self._remember_rst_html(key, html_string)
+        if isinstance(jobs, str):
+            jobs = int(jobs)
+        jobs = min(jobs or os.cpu_count() or 1, len(pending))
+        if jobs > 1 and "fork" not in multiprocessing.get_all_start_methods():
+            log.warning(
+                "Parallel RST conversion requires the 'fork' start method, "
+                "which is not available here. Converting serially."
+            )
+            jobs = 1
+        if jobs <= 1:
+            converted = list(map(_convert_rst, pending.values()))
+        else:
+            with ProcessPoolExecutor(
+                max_workers=jobs, mp_context=multiprocessing.get_context("fork")
+            ) as executor:
+                converted = list(executor.map(_convert_rst, pending.values()))
+        for key, html_string in zip(pending, converted, strict=True):
+            self._store_rst_html(key, html_string)
+        log.info("Converted %s RST files", len(pending))
+        return len(pending)
+
+    def _rst_to_html(self, rst_string):
+        """
+        Converts RST to html, unless already converted (see preload_rst and
+        the rst_cache_dir option)
+
+        Args:
+            rst_string: RST, str.
+
+        Returns: html body, Jinja tags included, str.
+        """
+        key = _rst_key(rst_string)
+        html_string = self._rst_html.get(key)
+        if html_string is None:
+            html_string = self._read_rst_cache(key)
+            if html_string is None:
+                html_string = _convert_rst(rst_string)
+                self._store_rst_html(key, html_string)
+                return html_string
+        self._remember_rst_html(key, html_string)
+        return html_string
+
+    def _remember_rst_html(self, key, html_string):
+        """Keeps the html of an RST conversion in memory, within bounds."""
+        self._rst_html.pop(key, None)
+        if len(self._rst_html) >= max(self.rst_cache_max_size, self._rst_preloaded):
+            self._rst_html.popitem(last=False)
+        self._rst_html[key] = html_string
+
+    def _read_rst_cache(self, key):
+        """Returns the html of a cached RST conversion, None if not cached."""
+        if not self.rst_cache_dir:
+            return None
+        path = os.path.join(self.rst_cache_dir, f"__flastik_rst_{key}.html")
+        try:
+            with open(path, encoding="utf-8") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _store_rst_html(self, key, html_string):
+        """Keeps the html of an RST conversion, in memory and cache folder."""
+        self._remember_rst_html(key, html_string)
+        if not self.rst_cache_dir:
+            return
+        path = os.path.join(self.rst_cache_dir, f"__flastik_rst_{key}.html")
+        # Note: written aside and moved, render workers may race
+        temp = f"{path}.{uuid4().hex}"
+        with open(temp, "w", encoding="utf-8") as f:
+            f.write(html_string)
+        os.replace(temp, path)
+
+    def _rst_template(self, html_string):
+        """Returns the template compiled from converted RST, Template."""
+        template = self._rst_templates.pop(html_string, None)
+        if template is None:
+            template = self.jinja_env.from_string(html_string)
+            if len(self._rst_templates) >= self.rst_cache_max_size:
+                self._rst_templates.popitem(last=False)
+        self._rst_templates[html_string] = template
+        return template
+
     def _generate_route_vars(self, found, kwargs_deco, route):
         """
         Generate the variables associated with a routing pattern.
@@ -702,10 +1245,9 @@ class Builder:
             kwargs_deco: dictionary of key arguments, dict.
             route: routing pattern, str.
 
-        Returns: list of tuples
+        Returns: RouteVars, expanding the tuples of route variables on demand
         """
         var_lists = []
-        route_vars = []
         all_strings = True
         # Checking list of values and list of lists
         for group in found:
@@ -729,126 +1271,2070 @@ class Builder:
                 var_val = self.check_vars_vs_type(var_type, var_name, values, route)
                 var_lists.append(var_val)
         log.debug(f"Var list: {var_lists}")
-        # Generate list of route variables
-        # - if dealing with a list of strings only
-        if all_strings:
-            route_vars = list(itertools.product(*var_lists))
-        # - otherwise
-        else:
-            required_keys = []
-            for key_list, group in zip(var_lists, found, strict=False):
+        # Checking the folder ramification
+        # Note: a dict of lists must follow a list whose values are its keys
+        if not all_strings:
+            required_keys = None
+            for key_list, group in zip(var_lists, found, strict=True):
                 var_name = group[1]
-                #  * first time around
-                if not route_vars:
-                    if isinstance(key_list, dict):  # Dict of list
+                if isinstance(key_list, dict):  # Dict of list
+                    if required_keys is None:  # first time around
                         msg = (
                             f"'{var_name}' dict requires {key_list.keys()} to be defined just before in the url."
                         )
                         log.error(msg)
                         raise FlastikError(msg)
-                    else:  # List of values
-                        route_vars = [[vv] for vv in key_list]
+                    # Dict keys must match previous ramification
+                    if set(key_list.keys()) != set(required_keys):  # Sanity check
+                        msg = f"'{var_name}' dict. requires {required_keys} as keys and not {key_list.keys()}."
+                        log.error(msg)
+                        raise FlastikError(msg)
+                    # - resets requirement
+                    required_keys = []
+                else:  # List of values
+                    # - defines ramification requirement for dict.
                     required_keys = key_list
-                #  * next time around
+
+        return RouteVars(var_lists)
+
+    def _iter_pages(self, views, selection=None):
+        """
+        Yields the pages of the given views, in build order.
+
+        Args:
+            views: names of the views, [str.,...,str.]
+
+        Keyword Args:
+            selection: pages of the views to yield, as _select_pages returns.
+                If None (default): every page is yielded.
+
+        Returns: iterator of (view name, route variables) tuples
+        """
+        for name in views:
+            route_vars = self.web_pages[name]["route_vars"]
+            positions = None if selection is None else selection[name]
+            if not route_vars:
+                yield name, ()
+            elif positions is None:
+                for vv in route_vars:
+                    yield name, vv
+            else:
+                for position in positions:
+                    yield name, route_vars[position]
+
+    def _select_pages(self, views, routes=None, where=None):
+        """
+        Selects the pages of the given views matching route patterns and
+        taking given values of their route variables (see build).
+
+        Routes are matched under the literal folder of each pattern only (see
+        _RouteRegistry.matching), and variable values by walking down the
+        matching branches of the route variables (see RouteVars.where), so
+        that the other pages are never looked at.
+
+        Args:
+            views: names of the views, [str.,...,str.]
+
+        Keyword Args:
+            routes: glob patterns, [str.,...,str.]
+            where: allowed values of route variables, {name: [value,...]}
+                dict, or ["name=value",...] list.
+
+        Returns: {view name: positions of the selected pages in its route
+            variables, list, or None for every page} dict, views without
+            selected pages left out
+        """
+        selection = dict.fromkeys(views)
+        if routes:
+            if isinstance(routes, str):
+                routes = [routes]
+            matched = {}
+            for pattern in routes:
+                for route in self.routes.matching(pattern):
+                    page, index = self.routes.locate(route)
+                    if page["name"] in selection:
+                        matched.setdefault(page["name"], set()).add(index)
+            # Note: views without variables have a single page, of index None
+            selection = {
+                name: sorted(matched[name]) if None not in matched[name] else None
+                for name in selection
+                if name in matched
+            }
+        if where:
+            if not isinstance(where, dict):
+                values = {}
+                for condition in where:
+                    var_name, equal, value = condition.partition("=")
+                    if not equal:
+                        msg = f"Invalid route variable condition '{condition}', expected name=value."
+                        log.error(msg)
+                        raise FlastikError(msg)
+                    values.setdefault(var_name, []).append(value)
+                where = values
+            unknown = set(where).difference(
+                *(self.web_pages[name]["key_args"] for name in views)
+            )
+            if unknown:
+                msg = f"No view has route variables named {sorted(unknown)}."
+                log.error(msg)
+                raise FlastikError(msg)
+            for name, positions in list(selection.items()):
+                key_args = self.web_pages[name]["key_args"]
+                if not set(where).issubset(key_args):
+                    del selection[name]
+                    continue
+                route_vars = self.web_pages[name]["route_vars"]
+                allowed = [where.get(arg) for arg in key_args]
+                if positions is None:
+                    selection[name] = list(route_vars.where(*allowed))
                 else:
-                    old_route_vars = route_vars.copy()
-                    route_vars = []
-                    if isinstance(key_list, dict):  # Dict of list
-                        # Dict keys must match previous ramification
-                        if set(key_list.keys()) != set(required_keys):  # Sanity check
-                            msg = f"'{var_name}' dict. requires {required_keys} as keys and not {key_list.keys()}."
-                            log.error(msg)
-                            raise FlastikError(msg)
-                        for rr in old_route_vars:
-                            lv = key_list[rr[-1]]
-                            for vv in lv:
-                                route_vars.append([*rr, vv])
-                        # - resets requirement
-                        required_keys = []
-                    else:  # List of values
-                        for rr in old_route_vars:
-                            for vv in key_list:
-                                route_vars.append([*rr, vv])
-                        # - defines ramification requirement for dict.
-                        required_keys = key_list
-            #  * turn inside lists into tuples
-            route_vars = [tuple(lv) for lv in route_vars]
-
-        return route_vars
+                    allowed = [
+                        None if values is None else {str(value) for value in values}
+                        for values in allowed
+                    ]
+                    selection[name] = [
+                        position
+                        for position in positions
+                        if all(
+                            values is None or str(value) in values
+                            for value, values in zip(route_vars[position], allowed, strict=True)
+                        )
+                    ]
+        return selection
 
-    def _write_html_file(self, html_name, route, rendered_html):
+    def _render_page(self, name, vv, stream=True):
         """
-        Write rendered html to file
+        Renders one page of a view
 
         Args:
-            html_name: file name, str.
-            route: path to file, str.
-            rendered_html: rendered html, str.
+            name: view name, str.
+            vv: route variables, tuple (empty for views without variables)
+
+        Keyword Args:
+            stream: boolean switch, bool.
+              If True (default): pages the view returns as a stream (see
+                stream_template) are written to their file as rendered.
+              If False: they are rendered to a string like the others.
+
+        Returns: route, html file name, rendered html (or, for streamed
+            pages, the number of bytes written), the files the page depends
+            on and the seconds spent rendering it and compiling templates,
+            (str., str., str. or int., [str.,...,str.], (float, float))
         """
-        # Put path together
-        html_path = os.path.join(self.dest, route, html_name)
-        # Overwrite check
-        if os.path.exists(html_path) and not self.overwrite:
-            return
-        # Write html file
-        with open(html_path, "w") as f:
-            f.write(rendered_html)
-        #  * change permission
-        os.chmod(html_path, self.html_umask)
+        page = self.web_pages[name]
+        route = page["route_pattern"] % vv if vv else page["route_pattern"]
+        self.current_route = route
+        self._page_dependencies = set()
+        self._compile_time = 0.0
+        start = time.perf_counter()
+        try:
+            rendered_html = page["view"](*vv)
+            # Note: streams are rendered while the page is current, since
+            #       url_for and the dependencies depend on it
+            if not isinstance(rendered_html, str):
+                if stream:
+                    rendered_html = self._stream_html_file(
+                        page["html_name"], route, rendered_html
+                    )
+                else:
+                    rendered_html = "".join(rendered_html)
+            timings = (time.perf_counter() - start, self._compile_time)
+            return (
+                route,
+                page["html_name"],
+                rendered_html,
+                sorted(self._page_dependencies),
+                timings,
+            )
+        finally:
+            self._page_dependencies = None
 
+    def watch(self, interval=1.0, rounds=None, **options):
+        """
+        Builds the web site and collects its static files, then keeps
+        watching the templates, RST files, static file sources, stylesheet
+        and favicon, rebuilding only the pages (and re-collecting only the
+        static files) affected whenever one of them changes.
+        The views and routes are kept in memory in between, so that a change
+        costs neither a new Python process nor a full build.
 
-# Misc library
-def check_url_for_unsafe_characters(url):
-    unsafe = {'"', "<", ">", "#", "%", "{", "}", "|", "^", "~", "[", "]", "`", " "}
-    found = unsafe.intersection(set(url))
-    if found:
-        msg = "{} is an unsafe url.\n'{}' should not be used.".format(url, ", ".join(found))
-        log.error(msg)
-        raise FlastikError(msg)
+        Keyword Args:
+            interval: number of seconds between two checks for changes, float.
+            rounds: number of checks before returning, int.
+                If None (default): watches until interrupted (Ctrl+C).
+            **options: options of the build method and of the
+                collect_static_files function.
+                Note: archives (see build's output) cannot be watched, since
+                      only a full build writes them.
+        """
+        if options.get("output"):
+            msg = "An archive output cannot be watched: build it once instead."
+            log.error(msg)
+            raise FlastikError(msg)
+        options.pop("changed", None)
+        self.build(**options)
+        collect_static_files(builder=self, **options)
+        print("Watching for changes. Press Ctrl+C to stop.")
+        watched = self._watched_files()
+        try:
+            while rounds is None or rounds > 0:
+                if rounds is not None:
+                    rounds -= 1
+                time.sleep(interval)
+                current = self._watched_files()
+                changed = sorted(
+                    path
+                    for path in watched.keys() | current.keys()
+                    if watched.get(path) != current.get(path)
+                )
+                if not changed:
+                    continue
+                log.info("Changed: %s", changed)
+                self.build(changed=changed, **options)
+                if any(StaticFile.storage.with_source(path, self) for path in changed):
+                    collect_static_files(builder=self, **options)
+                watched = self._watched_files()
+        except KeyboardInterrupt:
+            print("\nStopped watching.")
 
+    def serve(self, port=8000, host="127.0.0.1", cache_size=64 * 1024 * 1024):
+        """
+        Serves the web site locally for previewing, without building it:
+        pages are rendered when requested, and static files are served
+        straight from their sources.
 
-def check_path_for_illegal_characters(path):
-    unsafe = {".", '"', "[", "]", ":", ";", "|", "=", " ", "?", "$"}
-    found = unsafe.intersection(set(path))
-    if found:
-        msg = "{} is an illegal path.\n'{}' should not be used.".format(
-            path,
-            ", ".join(found),
+        Keyword Args:
+            port: port to listen to, int.
+            host: address to listen to, str.
+            cache_size: maximum number of bytes of rendered pages kept in
+                memory, int. The least recently requested pages are dropped
+                first.
+        """
+        server = self._make_server(host, port, cache_size)
+        print(
+            f"Serving on http://{host}:{server.server_address[1]}/ "
+            "Press Ctrl+C to stop."
         )
-        log.error(msg)
-        raise FlastikError(msg)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print("\nStopped serving.")
+        finally:
+            server.server_close()
 
+    def _make_server(self, host, port, cache_size):
+        """Returns the HTTP server behind serve(), ThreadingHTTPServer."""
+        server = ThreadingHTTPServer((host, port), _PreviewRequestHandler)
+        server.builder = self
+        server.pages = _PageCache(cache_size)
+        server.render_lock = threading.Lock()
+        return server
 
-def apply_umasks(path, dir_umask, file_umask):
-    """
-    Applies both dir. and file umasks recursively all the way to destination path
+    def _find_page(self, path):
+        """
+        Looks up the page served at a path
 
-    Args:
-        path: destination path, str.
-        dir_umask: directory umask, Operating-system mode bitfield
-        file_umask: file umask, Operating-system mode bitfield
-    """
-    for root, dirs, files in os.walk(path):
-        os.chmod(root, dir_umask)
-        for d in dirs:
-            os.chmod(os.path.join(root, d), dir_umask)
-        for f in files:
-            os.chmod(os.path.join(root, f), file_umask)
+        Args:
+            path: path relative to the web site root, str.
 
+        Returns: (view name, route variables) tuple, None if there is none.
+        """
+        found = self.routes.get(path)
+        if found is None or "view" not in found[0]:
+            return None
+        page, vv = found
+        return page["name"], vv
 
-def add_Builder_arguments(arg_parser):
-    """
-    Adds all arguments related to the 'Builder' class to a given ArgumentParser instance
-    Returns an extended ArgumentParser instance
+    def _find_static_file(self, path):
+        """
+        Looks up the source of the static file served at a path
 
-    Args:
-        arg_parser: ArgumentParser instance
+        Args:
+            path: path relative to the web site root, str.
 
-    Returns: ArgumentParser instance
-    """
-    arg_parser.add_argument(
-        "--log_level",
-        dest="log_level",
+        Returns: path to source, str. None if there is none.
+        """
+        folder, _, rest = path.partition("/")
+        if folder == "static":
+            if rest == "stylesheet.css":
+                return self._css_source
+            if rest == "favicon.ico":
+                return self._favicon_source
+            # Note: only files inside the Bootstrap folder are served, e.g.
+            #       not absolute paths, which os.path.join would honour
+            if not rest or os.path.isabs(rest):
+                return None
+            root = os.path.realpath(self.bootstrap_folder)
+            source = os.path.realpath(os.path.join(root, rest))
+            if os.path.commonpath([root, source]) != root:
+                return None
+            return source if os.path.isfile(source) else None
+        for record in StaticFile.storage.with_destination(folder, rest, self):
+            return record.source
+        return None
+
+    def _watched_files(self):
+        """
+        Returns the modification signature of every file watch() keeps an
+        eye on, as a {path: (size, mtime) or None} dict.
+        """
+        paths = {self._css_source, self._favicon_source}
+        paths.update(self._dependents)
+        paths.update(self._static_sources())
+        for folder in self.jinja_env.loader.searchpath:
+            for root, _, files in os.walk(folder):
+                paths.update(os.path.abspath(os.path.join(root, f)) for f in files)
+        signatures = {}
+        for path in paths:
+            try:
+                stat = os.stat(path)
+                signatures[path] = (stat.st_size, stat.st_mtime_ns)
+            except OSError:
+                signatures[path] = None
+        return signatures
+
+    def _static_sources(self):
+        """Returns the sources of the static files of this web site, list."""
+        return [record.source for record in StaticFile.storage.of(self)]
+
+    def _page_key(self, name, vv):
+        """Returns the path of a page relative to the web site root, str."""
+        page = self.web_pages[name]
+        route = page["route_pattern"] % vv if vv else page["route_pattern"]
+        return os.path.join(route, page["html_name"])
+
+    def _record_dependencies(self, name, vv, dependencies):
+        """Stores the files a page depended on when it was last rendered."""
+        key = self._page_key(name, vv)
+        self._forget_dependencies(key)
+        self._dependencies[key] = (name, tuple(vv), tuple(dependencies))
+        for path in dependencies:
+            self._dependents.setdefault(path, set()).add(key)
+
+    def _forget_dependencies(self, key):
+        """Removes a page from the dependency graph."""
+        entry = self._dependencies.pop(key, None)
+        if entry is None:
+            return
+        for path in entry[2]:
+            pages = self._dependents.get(path)
+            if pages is not None:
+                pages.discard(key)
+                if not pages:
+                    del self._dependents[path]
+
+    def _load_dependencies(self, manifest):
+        """Completes the dependency graph with the pages of a build manifest."""
+        for key, entry in manifest.pages.items():
+            if key not in self._dependencies and entry["view"] in self.web_pages:
+                self._record_dependencies(
+                    entry["view"], tuple(entry["route_vars"]), entry["dependencies"]
+                )
+
+    def _pages_affected_by(self, changed):
+        """
+        Returns the pages depending on any of the changed files
+
+        Args:
+            changed: paths to files, list
+
+        Returns: set of pages, as paths relative to the web site root
+        """
+        if isinstance(changed, str):
+            changed = [changed]
+        affected = set()
+        for path in changed:
+            affected.update(self._dependents.get(os.path.abspath(path), ()))
+        log.info("%s pages depend on %s", len(affected), changed)
+        return affected
+
+    def _depends_on(self, path):
+        """
+        Records that the page being rendered, if any, depends on a file
+
+        Args:
+            path: path to file, str. None is ignored.
+        """
+        if self._page_dependencies is not None and path:
+            self._page_dependencies.add(os.path.abspath(path))
+
+    def _render_pages(self, pages, jobs=1, page_count=None):
+        """
+        Renders the given pages, serially or across a pool of processes
+
+        Args:
+            pages: iterable of (view name, route variables) tuples
+            jobs: number of processes, int. None or 0 for one per CPU.
+            page_count: (maximum) number of pages, int.
+
+        Returns: iterator of ((view name, route variables), (route, html file
+            name, rendered html, dependencies)) tuples, in the order of
+            'pages' whatever the number of processes.
+        """
+        if isinstance(jobs, str):
+            jobs = int(jobs)
+        if not jobs:
+            jobs = os.cpu_count() or 1
+        if page_count is not None:
+            jobs = min(jobs, page_count)
+        if jobs > 1 and "fork" not in multiprocessing.get_all_start_methods():
+            log.warning(
+                "Parallel rendering requires the 'fork' start method, "
+                "which is not available here. Rendering serially."
+            )
+            jobs = 1
+        if jobs <= 1:
+            for page in pages:
+                yield page, self._render_page(*page)
+            return
+        # Note: forked workers inherit the views, which cannot be pickled,
+        #       and only exchange view names, route variables and results.
+        #       Pages are handed out in chunks, a few chunks per worker at a
+        #       time, so that they are never all held in memory.
+        chunksize = max(1, min(64, (page_count or 0) // (jobs * 8)))
+        executor = ProcessPoolExecutor(
+            max_workers=jobs,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=_init_render_worker,
+            initargs=(self,),
+        )
+        pending = deque()
+        try:
+            pages = iter(pages)
+            while True:
+                chunk = list(itertools.islice(pages, chunksize))
+                if chunk:
+                    pending.append((chunk, executor.submit(_render_in_worker, chunk)))
+                if pending and (not chunk or len(pending) >= 4 * jobs):
+                    chunk_done, future = pending.popleft()
+                    for page, (rendered, new_statics, changes) in zip(
+                        chunk_done, future.result(), strict=True
+                    ):
+                        # - static files created by the views belong to this
+                        #   process too, and so do the pages they streamed
+                        for static in new_statics:
+                            StaticFile._register(*static, builder=self)
+                        self._changes.extend(changes)
+                        yield page, rendered
+                elif not chunk:
+                    return
+        finally:
+            # Note: on error, do not wait for the pages still queued
+            executor.shutdown(cancel_futures=True)
+
+    def _sync_static_tree(self, source, dest, mirror=True):
+        """
+        Syncs a folder of the web site's static files with its source
+
+        Args:
+            source: path to source folder, str.
+            dest: path to destination folder, str.
+
+        Keyword Args:
+            mirror: boolean switch, bool.
+              If True (default): files no longer in the source folder are
+                removed, when overwriting.
+              If False: they are kept (e.g. 'static' also holds the style
+                sheet and favicon).
+        """
+        self.fs.makedirs(dest)
+        self.fs.chmod(dest, self.dir_umask)
+        names = os.listdir(source)
+        for name in names:
+            orig = os.path.join(source, name)
+            if os.path.isdir(orig):
+                self._sync_static_tree(orig, os.path.join(dest, name))
+            elif os.path.isfile(orig):
+                self._sync_static_file(orig, os.path.join(dest, name))
+        if mirror and self.overwrite and self.fs.shared:
+            for name in set(os.listdir(dest)).difference(names):
+                if name.endswith(".gz") and name[:-3] in names:
+                    continue  # Note: precompressed copy (see build)
+                path = os.path.join(dest, name)
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+                self._changes.add("removed", path)
+                log.debug("Removing %s", path)
+
+    def _sync_static_file(self, source, dest, transform=None):
+        """
+        Copies one of the web site's static files, unless its destination
+        already has the same content (or exists and is not to be overwritten).
+
+        Args:
+            source: path to source, str.
+            dest: path to destination, str.
+            transform: function turning the source's text into the
+                destination's (e.g. _minify_css), or None to copy it as is.
+        """
+        try:
+            mode = S_IMODE(os.stat(dest).st_mode) if self.fs.shared else None
+        except FileNotFoundError:
+            mode = None
+        if transform is None:
+            unchanged = mode is not None and filecmp.cmp(source, dest, shallow=False)
+        else:
+            with open(source) as f:
+                content = transform(f.read())
+            unchanged = False
+            if mode is not None:
+                with open(dest) as f:
+                    unchanged = f.read() == content
+        if mode is not None and (not self.overwrite or unchanged):
+            if mode != self.static_umask:
+                os.chmod(dest, self.static_umask)
+            return
+        if transform is None:
+            self.fs.copy(source, dest, self.static_umask)
+        else:
+            self.fs.write(dest, content, self.static_umask)
+        self._changes.add("added" if mode is None else "modified", dest)
+        log.info("Copying %s to %s", source, dest)
+
+    def _write_page(self, name, html_name, route, rendered_html):
+        """
+        Writes a rendered page of a view, minifying it if required and timing
+        it when reporting (see build).
+        """
+        if self.minify:
+            rendered_html = _minify_html(rendered_html)
+        if self._report is None:
+            self._write_html_file(html_name, route, rendered_html)
+            return
+        start = time.perf_counter()
+        status = self._write_html_file(html_name, route, rendered_html)
+        # Note: pages left untouched write no bytes
+        self._report.add_write(
+            name,
+            time.perf_counter() - start,
+            len(rendered_html.encode()) if status is not None else 0,
+        )
+
+    def _write_html_file(self, html_name, route, rendered_html):
+        """
+        Write rendered html to file
+
+        Args:
+            html_name: file name, str.
+            route: path to file, str.
+            rendered_html: rendered html, str.
+
+        Returns: "added", "modified", or None if the file was left untouched
+        """
+        # Put path together
+        html_path = os.path.join(self.dest, route, html_name)
+        # Overwrite check
+        if self.fs.exists(html_path) and not self.overwrite:
+            return None
+        # Write html file, with its permissions, unless it is up to date
+        status = self.fs.write_if_changed(html_path, rendered_html)
+        self._changes.add(status, html_path)
+        return status
+
+    def _stream_html_file(self, html_name, route, stream):
+        """
+        Write rendered html to file, chunk by chunk as it is rendered
+
+        Args:
+            html_name: file name, str.
+            route: path to file, str.
+            stream: rendered html, iterable of str. (e.g. TemplateStream)
+
+        Returns: number of bytes written, int. 0 if the page was left
+            untouched.
+        """
+        html_path = os.path.join(self.dest, route, html_name)
+        exists = self.fs.exists(html_path)
+        if exists and not self.overwrite:
+            for _ in stream:  # Note: still rendered, for its dependencies
+                pass
+            return 0
+        # Note: pages already there are streamed next to themselves, and only
+        #       moved over them if their content changed
+        target = f"{html_path}.{uuid4().hex}" if exists else html_path
+        try:
+            with self.fs.open(target, text=True) as f:
+                for chunk in stream:
+                    f.write(chunk)
+        except BaseException:
+            # Note: pages failing half-way leave neither a truncated page nor
+            #       a copy aside the existing one behind
+            if self.fs.exists(target):
+                self.fs.remove(target)
+            raise
+        size = self.fs.getsize(target)
+        status = self.fs.replace_if_changed(target, html_path) if exists else "added"
+        self._changes.add(status, html_path)
+        return size if status is not None else 0
+
+
+class RouteVars:
+    """
+    Route variables of a view, expanded on demand.
+
+    The variables are kept as the lists (or dicts of lists, keyed on the
+    value of the variable just before in the url) given to @Builder.route,
+    and the tuples of variables are only made when iterated over or indexed,
+    so that views with millions of pages are never held in memory at once.
+    Page counts are computed per branch and memoized, which keeps len() and
+    indexing cheap whatever the ramification.
+
+    RouteVars can be sliced into RouteVars sharing the same variables, e.g.
+    to spread the pages of a view across machines (see shard()).
+
+    Args:
+        levels: values of each variable, [list or {key: list},...]
+    """
+
+    def __init__(self, levels):
+        self.levels = [dict(level) if isinstance(level, dict) else list(level) for level in levels]
+        self._counts = {}
+        self._offset_tables = {}
+        self._range = range(self._count(0, None))
+
+    def _values(self, i, previous):
+        level = self.levels[i]
+        return level[previous] if isinstance(level, dict) else level
+
+    def _is_dict(self, i):
+        return i < len(self.levels) and isinstance(self.levels[i], dict)
+
+    def _count(self, i, previous):
+        """Returns the number of tuples of variables from level i on, int."""
+        if i == len(self.levels):
+            return 1
+        key = (i, previous if self._is_dict(i) else None)
+        if key not in self._counts:
+            values = self._values(i, previous)
+            if self._is_dict(i + 1):
+                count = sum(self._count(i + 1, value) for value in values)
+            else:
+                count = len(values) * self._count(i + 1, None)
+            self._counts[key] = count
+        return self._counts[key]
+
+    def _get(self, index):
+        """Returns the index-th tuple of variables of the whole expansion."""
+        vv = []
+        previous = None
+        for i in range(len(self.levels)):
+            values = self._values(i, previous)
+            if self._is_dict(i + 1):
+                for value in values:
+                    count = self._count(i + 1, value)
+                    if index < count:
+                        break
+                    index -= count
+            else:
+                count = self._count(i + 1, None)
+                value = values[index // count]
+                index %= count
+            vv.append(value)
+            previous = value
+        return tuple(vv)
+
+    def _expand(self, i, previous, vv):
+        if i == len(self.levels):
+            yield vv
+            return
+        for value in self._values(i, previous):
+            yield from self._expand(i + 1, value, (*vv, value))
+
+    def __iter__(self):
+        if self._range != range(self._count(0, None)):
+            return (self._get(index) for index in self._range)
+        if not any(isinstance(level, dict) for level in self.levels):
+            return itertools.product(*self.levels)
+        return self._expand(0, None, ())
+
+    def __len__(self):
+        return len(self._range)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            # Note: the subset shares the variables and page counts
+            subset = RouteVars.__new__(RouteVars)
+            subset.levels = self.levels
+            subset._counts = self._counts
+            subset._offset_tables = self._offset_tables
+            subset._range = self._range[key]
+            return subset
+        return self._get(self._range[key])
+
+    def __eq__(self, other):
+        if isinstance(other, (RouteVars, list, tuple)):
+            return len(self) == len(other) and all(
+                vv == tuple(other_vv) for vv, other_vv in zip(self, other, strict=True)
+            )
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"RouteVars({self.levels!r})[{self._range.start}:{self._range.stop}:{self._range.step}]"
+
+    def shard(self, index, count):
+        """
+        Returns one of 'count' interleaved shares of the route variables
+
+        Args:
+            index: share number, from 0 to count - 1, int.
+            count: number of shares, int.
+
+        Returns: RouteVars
+        """
+        if not 0 <= index < count:
+            msg = f"Shard index must be between 0 and {count - 1}, not {index}."
+            log.error(msg)
+            raise FlastikError(msg)
+        return self[index::count]
+
+    def index(self, vv):
+        """
+        Returns the position of a tuple of variables, found by adding up the
+        page counts of the branches before each of its values.
+
+        Args:
+            vv: values of the variables, or their str. forms (as in urls).
+
+        Returns: position, int. Raises ValueError if not found.
+        """
+        if len(vv) != len(self.levels):
+            raise ValueError(f"{vv!r} is not in RouteVars")
+        index = 0
+        previous = None
+        for i, value in enumerate(vv):
+            found = self._offsets(i, previous).get(str(value))
+            if found is None:
+                raise ValueError(f"{vv!r} is not in RouteVars")
+            previous, offset = found
+            index += offset
+        if index not in self._range:
+            raise ValueError(f"{vv!r} is not in RouteVars")
+        return self._range.index(index)
+
+    def _offsets(self, i, previous):
+        """
+        Returns {str(value): (value, index of its first tuple from level i)}
+        for the values of level i, memoized.
+        """
+        key = (i, previous if self._is_dict(i) else None)
+        if key not in self._offset_tables:
+            table = {}
+            offset = 0
+            for value in self._values(i, previous):
+                table.setdefault(str(value), (value, offset))
+                offset += self._count(i + 1, value if self._is_dict(i + 1) else None)
+            self._offset_tables[key] = table
+        return self._offset_tables[key]
+
+    def where(self, *allowed):
+        """
+        Returns the positions of the tuples of variables taking given values.
+
+        Only the branches of the variables leading to allowed values are
+        walked down, and the positions below a branch whose variables are
+        not constrained any further are counted rather than enumerated.
+
+        Args:
+            *allowed: allowed values of each variable, in route order, list.
+                None allows any value, an empty list none. Values are
+                compared as str.
+                Ex.: route_vars.where(None, [2021]) for the second variable
+
+        Returns: iterator of positions, in increasing order, int.
+              Ex.: [route_vars[i] for i in route_vars.where(None, [2021])]
+        """
+        allowed = [
+            None if values is None else {str(value) for value in values}
+            for values in allowed
+        ]
+        allowed += [None] * (len(self.levels) - len(allowed))
+        indices = self._where(0, None, 0, allowed)
+        if self._range == range(self._count(0, None)):
+            return indices
+        return (self._range.index(i) for i in indices if i in self._range)
+
+    def _where(self, i, previous, offset, allowed):
+        if all(values is None for values in allowed[i:]):
+            yield from range(offset, offset + self._count(i, previous))
+            return
+        for value in self._values(i, previous):
+            count = self._count(i + 1, value if self._is_dict(i + 1) else None)
+            if allowed[i] is None or str(value) in allowed[i]:
+                yield from self._where(i + 1, value, offset, allowed)
+            offset += count
+
+
+class _RouteRegistry:
+    """
+    Routes of a web site, i.e. the paths of its pages relative to the web
+    site root, in the order they were registered.
+
+    Routes are not listed one by one: the registry keeps the route pattern
+    of each view along with its route variables (see RouteVars), so that
+    memory stays flat however many pages a view has. A route is resolved by
+    splitting it between the literal parts of the patterns and indexing the
+    route variables with the values it holds, and prefix queries turn the folders of the prefix
+    into allowed values of the route variables (see RouteVars.where).
+    Routes of views without variables are kept in a hash table.
+
+    Note: compares equal to the list of its routes.
+    """
+
+    def __init__(self):
+        self.views = []  # (page, literals, segments, var_types) in registration order
+        self.fixed = {}  # route -> page, for views without variables
+
+    @staticmethod
+    def route_of(page, vv):
+        """Returns the route of a page of a view, str."""
+        route = page["route_pattern"] % tuple(vv) if vv else page["route_pattern"]
+        return os.path.join(route, page["html_name"])
+
+    def add(self, page, var_types=()):
+        """
+        Registers the routes of a view
+
+        Args:
+            page: view parameters, as stored in Builder.web_pages, dict.
+
+        Keyword Args:
+            var_types: types of the route variables, in route order, list of str.
+                Ex.: ["int", "string"]
+        """
+        if not page["route_vars"]:
+            self.fixed[self.route_of(page, ())] = page
+            self.views.append((page, None, None, ()))
+            return
+        literals = tuple(os.path.join(page["route_pattern"], page["html_name"]).split("%s"))
+        # Note: variables whose values hold slashes span folders, as 'path'
+        #       ones do, and are registered as such
+        var_types = tuple(
+            "path"
+            if any(
+                "/" in str(value)
+                for values in (level.values() if isinstance(level, dict) else [level])
+                for value in values
+            )
+            else var_type
+            for var_type, level in zip(var_types, page["route_vars"].levels, strict=True)
+        )
+        folders = page["route_pattern"].strip("/")
+        segments = folders.split("/") if folders else []
+        self.views.append((page, literals, segments, var_types))
+
+    def locate(self, route):
+        """
+        Returns the (view parameters, index of its route variables) of a
+        route, or None. The index is None for views without variables.
+        """
+        page = self.fixed.get(route)
+        if page is not None:
+            return page, None
+        for entry in self.views:
+            index = self._index_in(entry, route)
+            if index is not None:
+                return entry[0], index
+        return None
+
+    @classmethod
+    def _index_in(cls, entry, route):
+        """Returns the index of a route in a view's route variables, or None."""
+        return next(cls._indices_in(entry, route), None)
+
+    @staticmethod
+    def _indices_in(entry, route):
+        """
+        Yields the indices of a route in a view's route variables.
+
+        Values may hold the literal parts of the pattern around them (e.g.
+        the '_' of '%s_%s/index.html', or slashes), so each split of the
+        route between these parts is looked up among the values of each
+        variable, down the branches of the values found.
+        """
+        page, literals, _, _ = entry
+        if literals is None or not route.startswith(literals[0]):
+            return
+        route_vars = page["route_vars"]
+        last = len(literals) - 2
+
+        def splits(i, start, previous):
+            following = literals[i + 1]
+            if i == last:
+                end = len(route) - len(following)
+                ends = [end] if end >= start and route.endswith(following) else []
+            else:
+                ends = []
+                end = route.find(following, start)
+                while end != -1:
+                    ends.append(end)
+                    end = route.find(following, end + 1)
+            values = route_vars._offsets(i, previous)
+            for end in ends:
+                found = values.get(route[start:end])
+                if found is None:
+                    continue
+                if i == last:
+                    yield (found[0],)
+                else:
+                    for rest in splits(i + 1, end + len(following), found[0]):
+                        yield (found[0], *rest)
+
+        for vv in splits(0, len(literals[0]), None):
+            try:
+                yield route_vars.index(vv)
+            except ValueError:  # Note: outside of a slice of the variables
+                continue
+
+    def get(self, route):
+        """Returns the (view parameters, route variables) of a route, or None."""
+        found = self.locate(route)
+        if found is None:
+            return None
+        page, index = found
+        return page, () if index is None else page["route_vars"][index]
+
+    def collision(self, page, var_types=()):
+        """
+        Returns a route of a view which another view already uses, or None.
+
+        Routes of views with variables are only compared with the routes of
+        views whose patterns could produce the same ones, by looking up the
+        routes of the view with fewer pages in the other one. Views whose
+        routes may repeat themselves (see _may_repeat) are also checked
+        route by route.
+        """
+        if not page["route_vars"]:
+            route = self.route_of(page, ())
+            return route if route in self else None
+        new = _RouteRegistry()
+        new.add(page, var_types)
+        entry = new.views[0]
+        if self._may_repeat(entry):
+            routes = set()
+            for vv in page["route_vars"]:
+                route = self.route_of(page, vv)
+                if route in routes:
+                    return route
+                routes.add(route)
+        for route in self.fixed:
+            if new._index_in(entry, route) is not None:
+                return route
+        for other in self.views:
+            if other[1] is None or not self._may_collide(entry, other):
+                continue
+            smaller, larger = sorted(
+                (entry, other), key=lambda e: len(e[0]["route_vars"])
+            )
+            for vv in smaller[0]["route_vars"]:
+                route = self.route_of(smaller[0], vv)
+                if self._index_in(larger, route) is not None:
+                    return route
+        return None
+
+    @staticmethod
+    def _may_repeat(entry):
+        """
+        Whether different values of a view's route variables could make the
+        same route, i.e. whether a folder holds several variables, or a
+        variable spanning folders is not alone. The values of each variable
+        of the other views are merely checked for repeats (see
+        Builder.route).
+        """
+        _, _, segments, var_types = entry
+        return any(segment.count("%s") > 1 for segment in segments) or (
+            "path" in var_types and len(var_types) > 1
+        )
+
+    @staticmethod
+    def _may_collide(entry, other):
+        """Whether two views' route patterns could produce the same route."""
+        if "path" in entry[3] or "path" in other[3]:
+            return True
+        if entry[0]["html_name"] != other[0]["html_name"]:
+            return False
+        if len(entry[2]) != len(other[2]):
+            return False
+        return all(
+            "%s" in mine or "%s" in theirs or mine == theirs
+            for mine, theirs in zip(entry[2], other[2], strict=True)
+        )
+
+    def under(self, prefix):
+        """
+        Returns the routes of the pages under a folder of the web site
+
+        Args:
+            prefix: folder, relative to the web site root, str.
+                Ex.: "cruise/2021/" or "/cruise/2021"
+
+        Returns: sorted list of routes
+        """
+        prefix = prefix.strip("/")
+        parts = prefix.split("/") if prefix else []
+        prefix = prefix + "/" if prefix else ""
+        routes = []
+        for page, _, segments, var_types in self.views:
+            if segments is None:
+                route = self.route_of(page, ())
+                if route.startswith(prefix):
+                    routes.append(route)
+                continue
+            positions = self._positions_under(page, segments, var_types, parts)
+            if positions is None:
+                continue
+            routes.extend(
+                route
+                for route in (self.route_of(page, page["route_vars"][p]) for p in positions)
+                if route.startswith(prefix)
+            )
+        return sorted(routes)
+
+    @staticmethod
+    def _positions_under(page, segments, var_types, parts):
+        """
+        Returns the positions of the route variables of a view whose routes
+        may lie under the folders 'parts', None if none can.
+        Folders matching a whole variable (but for 'path' ones) become its
+        allowed value, the remaining routes being filtered by the caller.
+        """
+        allowed = [None] * len(var_types)
+        var = 0
+        for part, segment in zip(parts, segments, strict=False):
+            count = segment.count("%s")
+            if count == 0:
+                if part != segment:
+                    return None
+            elif segment == "%s" and var_types[var] != "path":
+                allowed[var] = [part]
+            else:
+                break  # Note: the rest is filtered route by route
+            var += count
+        else:
+            if len(parts) > len(segments) and "path" not in var_types:
+                return None
+        return page["route_vars"].where(*allowed)
+
+    def matching(self, pattern):
+        """
+        Returns the routes of the pages, or of their folders, matching a glob
+        pattern (see fnmatch). Only the routes under the folder the pattern
+        starts with are matched (see under).
+
+        Args:
+            pattern: glob pattern, relative to the web site root, str.
+                Ex.: "cruise/2021/*" or "cruise/*/leg_1"
+
+        Returns: sorted list of routes
+        """
+        pattern = pattern.strip("/")
+        literal = re.split(r"[*?[]", pattern, maxsplit=1)[0]
+        return [
+            route
+            for route in self.under(literal.rpartition("/")[0])
+            if fnmatch.fnmatchcase(route, pattern)
+            or fnmatch.fnmatchcase(os.path.dirname(route), pattern)
+        ]
+
+    def __contains__(self, route):
+        return self.locate(route) is not None
+
+    def __iter__(self):
+        for page, literals, _, _ in self.views:
+            if literals is None:
+                yield self.route_of(page, ())
+            else:
+                for vv in page["route_vars"]:
+                    yield self.route_of(page, vv)
+
+    def __len__(self):
+        return sum(len(page["route_vars"]) or 1 for page, _, _, _ in self.views)
+
+    def __eq__(self, other):
+        if isinstance(other, (_RouteRegistry, list, tuple)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"{type(self).__name__}({list(self)!r})"
+
+
+class _BuildManifest:
+    """
+    Record of the pages of a web site as of its last incremental build,
+    kept in dest/.flastik/manifest.json (see Builder.build).
+
+    Each page, keyed by its path relative to the web site root, records its
+    route, view name, route variables, the files it depended on (templates,
+    RST files and static file sources, see Builder.dependencies) and a
+    fingerprint of all these inputs. A page is up to date when its
+    fingerprint, recomputed against the current view code and file
+    contents, is unchanged.
+    """
+
+    # Note: bump when the manifest layout or the fingerprint change
+    format = 2
+    # Files larger than this are fingerprinted by size and modification time
+    # rather than content (e.g. downloads, whose content the page never sees)
+    max_hashed_size = 1024 * 1024
+
+    def __init__(self, builder):
+        self.builder = builder
+        self.path = os.path.join(builder.dest, ".flastik", "manifest.json")
+        self.pages = {}
+        self.digests = {}
+        self.view_digests = {}
+        self.exists = os.path.isfile(self.path)
+        try:
+            with open(self.path) as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as err:
+            log.warning("Ignoring unreadable build manifest %s: %s", self.path, err)
+            return
+        if manifest.get("format") != self.format:
+            log.info("Ignoring build manifest %s: outdated format", self.path)
+            return
+        self.pages = manifest["pages"]
+
+    def is_up_to_date(self, name, vv):
+        """
+        Tells whether a page is unchanged since the previous build
+
+        Args:
+            name: view name, str.
+            vv: route variables, tuple
+
+        Returns: bool
+        """
+        key = self.builder._page_key(name, vv)
+        entry = self.pages.get(key)
+        if entry is None or entry["view"] != name:
+            return False
+        if not os.path.isfile(os.path.join(self.builder.dest, key)):
+            return False
+        return entry["fingerprint"] == self.fingerprint(name, vv, entry["dependencies"])
+
+    def record(self, name, vv, dependencies, raw_digest=None):
+        """
+        Records a page that has just been rendered
+
+        Args:
+            name: view name, str.
+            vv: route variables, tuple
+            dependencies: paths to the files the page depended on, list
+            raw_digest: digest of the html rendered before minification, str.
+        """
+        page = self.builder.web_pages[name]
+        entry = {
+            "route": page["route_pattern"] % vv if vv else page["route_pattern"],
+            "view": name,
+            "route_vars": list(vv),
+            "dependencies": dependencies,
+            "fingerprint": self.fingerprint(name, vv, dependencies),
+        }
+        if raw_digest is not None:
+            entry["raw_digest"] = raw_digest
+        self.pages[self.builder._page_key(name, vv)] = entry
+
+    def has_output(self, key, raw_digest):
+        """
+        Tells whether a page was last built from the same rendered html, and
+        is still there
+
+        Args:
+            key: path of the page relative to the web site root, str.
+            raw_digest: digest of the html rendered before minification, str.
+
+        Returns: bool
+        """
+        entry = self.pages.get(key)
+        return (
+            raw_digest is not None
+            and entry is not None
+            and entry.get("raw_digest") == raw_digest
+            and os.path.isfile(os.path.join(self.builder.dest, key))
+        )
+
+    def fingerprint(self, name, vv, dependencies):
+        """Returns a digest of everything a page is made from, str."""
+        if name not in self.view_digests:
+            self.view_digests[name] = _code_digest(self.builder.web_pages[name]["view"].__code__)
+        inputs = [
+            name,
+            self.builder.web_pages[name]["html_name"],
+            list(vv),
+            self.view_digests[name],
+            self.builder.meta,
+            [(path, self.digest(path)) for path in dependencies],
+        ]
+        if self.builder.minify:
+            inputs.append("minify")
+        inputs = json.dumps(inputs, sort_keys=True, default=str)
+        return hashlib.sha1(inputs.encode()).hexdigest()
+
+    def digest(self, path):
+        """Returns the digest of a file, None if it is missing."""
+        if path not in self.digests:
+            try:
+                stat = os.stat(path)
+                if stat.st_size > self.max_hashed_size:
+                    self.digests[path] = f"{stat.st_size}:{stat.st_mtime_ns}"
+                else:
+                    with open(path, "rb") as f:
+                        self.digests[path] = hashlib.sha1(f.read()).hexdigest()
+            except OSError:
+                self.digests[path] = None
+        return self.digests[path]
+
+    def remove_stale_pages(self):
+        """
+        Deletes the pages whose routes are no longer defined, along with the
+        folders this leaves empty.
+
+        Returns: paths of the deleted pages, relative to the web site root
+        """
+        routes = self.builder.routes
+        removed = []
+        for key in [key for key in self.pages if key not in routes]:
+            del self.pages[key]
+            path = os.path.join(self.builder.dest, key)
+            if not os.path.isfile(path):
+                continue
+            os.remove(path)
+            if os.path.isfile(path + ".gz"):  # see Builder.build's precompress
+                os.remove(path + ".gz")
+            removed.append(key)
+            folder = os.path.dirname(path)
+            while os.path.abspath(folder) != os.path.abspath(self.builder.dest):
+                try:
+                    os.rmdir(folder)
+                except OSError:  # not empty
+                    break
+                folder = os.path.dirname(folder)
+        return removed
+
+    def save(self):
+        """Writes the manifest, atomically."""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temporary = f"{self.path}.{os.getpid()}.tmp"
+        with open(temporary, "w") as f:
+            json.dump({"format": self.format, "pages": self.pages}, f)
+        os.replace(temporary, self.path)
+
+
+def _code_digest(code):
+    """
+    Returns a digest of a code object which, unlike its repr, is the same
+    from one Python process to the next, str.
+    """
+    digest = hashlib.sha1(code.co_code)
+    digest.update(repr(code.co_names).encode())
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            digest.update(_code_digest(const).encode())
+        elif isinstance(const, frozenset):  # Note: iteration order is random
+            digest.update(repr(sorted(map(repr, const))).encode())
+        else:
+            digest.update(repr(const).encode())
+    return digest.hexdigest()
+
+
+class _PageCache:
+    """
+    Size-bounded, least-recently-used cache of the pages rendered by
+    Builder.serve.
+    """
+
+    def __init__(self, max_size):
+        """
+        Args:
+            max_size: maximum number of bytes held, int.
+        """
+        self.max_size = max_size
+        self.size = 0
+        self.pages = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        """Returns a cached page, bytes. None if it is not cached."""
+        with self.lock:
+            page = self.pages.get(path)
+            if page is not None:
+                self.pages.move_to_end(path)
+            return page
+
+    def put(self, path, page):
+        """Caches a page, evicting the least recently used ones if need be."""
+        if len(page) > self.max_size:
+            return
+        with self.lock:
+            if path in self.pages:
+                self.size -= len(self.pages.pop(path))
+            self.pages[path] = page
+            self.size += len(page)
+            while self.size > self.max_size:
+                _, evicted = self.pages.popitem(last=False)
+                self.size -= len(evicted)
+
+
+class _PreviewRequestHandler(BaseHTTPRequestHandler):
+    """Request handler of Builder.serve."""
+
+    def do_GET(self):
+        self.respond(with_body=True)
+
+    def do_HEAD(self):
+        self.respond(with_body=False)
+
+    def respond(self, with_body):
+        builder = self.server.builder
+        path = unquote(urlsplit(self.path).path).lstrip("/")
+        if not path or path.endswith("/"):
+            path += "index.html"
+        # Note: '..' and empty segments (e.g. '/static//etc/passwd', or
+        #       '%2F'-encoded slashes) could reach outside the web site
+        if any(segment in ("", ".", "..") for segment in path.split("/")):
+            self.send_error(404)
+            return
+        # - pages
+        page = builder._find_page(path)
+        if page is not None:
+            body = self.server.pages.get(path)
+            if body is None:
+                try:
+                    body = self.render(*page)
+                except Exception:
+                    log.error("Rendering %s failed", path, exc_info=True)
+                    self.send_error(500, explain=traceback.format_exc())
+                    return
+                self.server.pages.put(path, body)
+            self.send_body(body, "text/html; charset=utf-8", with_body)
+            return
+        # - folders requested without their trailing slash
+        if builder._find_page(os.path.join(path, "index.html")) is not None:
+            self.send_response(301)
+            self.send_header("Location", f"/{path}/")
+            self.end_headers()
+            return
+        # - static files
+        source = builder._find_static_file(path)
+        if source is None:
+            self.send_error(404)
+            return
+        try:
+            with open(source, "rb") as f:
+                body = f.read()
+        except OSError:
+            self.send_error(404)
+            return
+        content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        self.send_body(body, content_type, with_body)
+
+    def render(self, name, vv):
+        """Renders a page the way Builder.build does, bytes."""
+        builder = self.server.builder
+        # Note: the Builder keeps the page being rendered in its state
+        with self.server.render_lock:
+            previously_rendering = Builder._rendering
+            Builder._rendering = builder
+            try:
+                rendered_html = builder._render_page(name, vv, stream=False)[2]
+            finally:
+                Builder._rendering = previously_rendering
+        return rendered_html.encode()
+
+    def send_body(self, body, content_type, with_body):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if with_body:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.info("%s - %s", self.address_string(), format % args)
+
+
+class _ChangeSet:
+    """
+    Files added, modified and removed by a build (see Builder.build).
+
+    Args:
+        root: path to the web site root, str.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.changes = []  # (status, path) in the order they happened
+        self.lock = threading.Lock()
+
+    def add(self, status, path):
+        """Records a change, unless status is None (unchanged file)."""
+        if status is not None:
+            with self.lock:
+                self.changes.append((status, path))
+
+    def extend(self, changes):
+        """Records changes made elsewhere (e.g. by a render worker)."""
+        with self.lock:
+            self.changes.extend(changes)
+
+    def summary(self):
+        """
+        Returns: {"added": [...], "modified": [...], "removed": [...]} dict of
+            sorted paths, relative to the web site root
+        """
+        status_of = {}
+        for status, path in self.changes:
+            path = os.path.relpath(path, self.root).replace(os.sep, "/")
+            if status_of.get(path) == "added" and status == "modified":
+                continue  # Note: still new to whoever syncs the web site
+            status_of[path] = status
+        summary = {"added": [], "modified": [], "removed": []}
+        for path, status in sorted(status_of.items()):
+            summary[status].append(path)
+        return summary
+
+    def save(self, path):
+        """Saves the summary as JSON"""
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+
+
+class _BuildReport:
+    """
+    Timings and sizes of the pages of a build, per view (see Builder.build).
+
+    Args:
+        slowest: number of slowest pages to keep track of, int.
+    """
+
+    def __init__(self, slowest=20):
+        self.slowest = slowest
+        self.views = {}
+        self.slowest_pages = []  # min-heap of (seconds, order, page)
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def view(self, name):
+        if name not in self.views:
+            self.views[name] = {
+                "render_seconds": [],
+                "write_seconds": 0.0,
+                "bytes_written": 0,
+                "template_compile_seconds": 0.0,
+            }
+        return self.views[name]
+
+    def add_render(self, name, vv, route, html_name, seconds, compile_seconds):
+        """Records the time spent rendering a page."""
+        with self.lock:
+            view = self.view(name)
+            view["render_seconds"].append(seconds)
+            view["template_compile_seconds"] += compile_seconds
+            if not self.slowest:
+                return
+            page = {
+                "view": name,
+                "route_vars": list(vv),
+                "page": os.path.join(route, html_name),
+                "render_seconds": seconds,
+            }
+            self.count += 1
+            if len(self.slowest_pages) < self.slowest:
+                heapq.heappush(self.slowest_pages, (seconds, self.count, page))
+            elif seconds > self.slowest_pages[0][0]:
+                heapq.heapreplace(self.slowest_pages, (seconds, self.count, page))
+
+    def add_write(self, name, seconds, size):
+        """Records the time spent writing a page, and its size in bytes."""
+        with self.lock:
+            view = self.view(name)
+            view["write_seconds"] += seconds
+            view["bytes_written"] += size
+
+    def summary(self, build_seconds):
+        """Returns the report, dict."""
+        views = {}
+        for name, view in sorted(self.views.items()):
+            times = sorted(view["render_seconds"])
+            total = sum(times)
+            views[name] = {
+                "pages": len(times),
+                "render_seconds": {
+                    "total": total,
+                    "mean": total / len(times) if times else 0.0,
+                    "p95": times[max(0, math.ceil(0.95 * len(times)) - 1)] if times else 0.0,
+                },
+                "write_seconds": view["write_seconds"],
+                "bytes_written": view["bytes_written"],
+                "template_compile_seconds": view["template_compile_seconds"],
+            }
+        return {
+            "build_seconds": build_seconds,
+            "pages": sum(view["pages"] for view in views.values()),
+            "views": views,
+            "slowest_pages": [page for _, _, page in sorted(self.slowest_pages, reverse=True)],
+        }
+
+    def save(self, path, build_seconds):
+        """
+        Saves the report as JSON, and as a Prometheus text file next to it
+
+        Args:
+            path: path to the JSON report, str.
+            build_seconds: duration of the build, float.
+        """
+        summary = self.summary(build_seconds)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(summary, f, indent=2, default=str)
+        metrics = [
+            ("pages", "Pages rendered", lambda v: v["pages"]),
+            ("render_seconds", "Seconds spent rendering pages",
+             lambda v: v["render_seconds"]["total"]),
+            ("render_seconds_mean", "Mean seconds spent rendering a page",
+             lambda v: v["render_seconds"]["mean"]),
+            ("render_seconds_p95", "95th percentile of the seconds spent rendering a page",
+             lambda v: v["render_seconds"]["p95"]),
+            ("write_seconds", "Seconds spent writing pages",
+             lambda v: v["write_seconds"]),
+            ("bytes_written", "Bytes of pages written",
+             lambda v: v["bytes_written"]),
+            ("template_compile_seconds", "Seconds spent compiling templates",
+             lambda v: v["template_compile_seconds"]),
+        ]
+        lines = [
+            "# HELP flastik_build_seconds Seconds spent building the web site",
+            "# TYPE flastik_build_seconds gauge",
+            f"flastik_build_seconds {summary['build_seconds']}",
+        ]
+        # Note: gauges, since each build's figures replace the previous ones
+        #       (hence no '_total' suffix, which is for counters)
+        for metric, description, value in metrics:
+            lines.append(f"# HELP flastik_view_{metric} {description}, per view")
+            lines.append(f"# TYPE flastik_view_{metric} gauge")
+            for name, view in summary["views"].items():
+                lines.append(f'flastik_view_{metric}{{view="{name}"}} {value(view)}')
+        with open(os.path.splitext(path)[0] + ".prom", "w") as f:
+            f.write("\n".join(lines) + "\n")
+
+
+class _FileSystem:
+    """
+    Makes the folders and files of a web site with their permissions.
+
+    Files and folders are created with their mode rather than chmod-ed
+    afterwards, which only happens when the process umask strips some of its
+    bits or an existing entry has another mode. Folders made once are
+    remembered, so that pages sharing a folder do not check it again.
+
+    Args:
+        dir_mode: mode of the folders, Operating-system mode bitfield.
+        file_mode: default mode of the files, Operating-system mode bitfield.
+    """
+
+    shared = True  # Note: render workers can write to it too
+
+    def __init__(self, dir_mode, file_mode):
+        self.dir_mode = dir_mode
+        self.file_mode = file_mode
+        umask = os.umask(0)
+        os.umask(umask)
+        self.umask = umask
+        self.made = set()
+
+    def makedirs(self, path):
+        """Makes a folder and its missing parents, with dir_mode."""
+        if path in self.made:
+            return
+        missing = []
+        parent = path
+        while parent and not os.path.isdir(parent):
+            missing.append(parent)
+            parent = os.path.dirname(parent)
+        for folder in reversed(missing):
+            try:
+                os.mkdir(folder, self.dir_mode)
+            except FileExistsError:  # e.g. made by another thread
+                continue
+            if self.dir_mode & self.umask:
+                os.chmod(folder, self.dir_mode)
+            log.debug("Making %s", folder)
+        self.made.add(path)
+
+    def chmod(self, path, mode):
+        """Changes the mode of a file or folder, unless already right."""
+        if S_IMODE(os.stat(path).st_mode) != mode:
+            os.chmod(path, mode)
+
+    exists = staticmethod(os.path.exists)
+    getsize = staticmethod(os.path.getsize)
+    remove = staticmethod(os.remove)
+
+    def open(self, path, mode=None, text=False):
+        """
+        Opens a file for writing, making it with its mode
+
+        Args:
+            path: path to file, str.
+
+        Keyword Args:
+            mode: mode of the file, Operating-system mode bitfield.
+              If None (default): file_mode
+            text: whether to open it in text mode, bool.
+
+        Returns: file object
+        """
+        if mode is None:
+            mode = self.file_mode
+        flags = os.O_WRONLY | os.O_CREAT | getattr(os, "O_BINARY", 0)
+        try:
+            fd = os.open(path, flags | os.O_EXCL, mode)
+            if mode & self.umask:
+                os.fchmod(fd, mode)
+        except FileExistsError:
+            fd = os.open(path, flags | os.O_TRUNC, mode)
+            if S_IMODE(os.fstat(fd).st_mode) != mode:
+                os.fchmod(fd, mode)
+        return os.fdopen(fd, "w" if text else "wb")
+
+    def write(self, path, data, mode=None):
+        """Writes data (str. or bytes) to a file made with its mode."""
+        with self.open(path, mode, text=isinstance(data, str)) as f:
+            f.write(data)
+
+    def copy(self, source, dest, mode=None):
+        """Copies a file's content to a file made with its mode."""
+        with open(source, "rb") as src, self.open(dest, mode) as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+
+    def write_if_changed(self, path, data, mode=None):
+        """
+        Writes data (str. or bytes) to a file made with its mode, unless the
+        file already holds that content, in which case it is left untouched
+        (but for its mode).
+
+        Returns: "added", "modified", or None if the file was unchanged
+        """
+        if mode is None:
+            mode = self.file_mode
+        content = data.encode() if isinstance(data, str) else data
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self.write(path, content, mode)
+            return "added"
+        # Note: files of another size cannot hold the same content
+        if stat.st_size == len(content):
+            with open(path, "rb") as f:
+                unchanged = f.read() == content
+            if unchanged:
+                if S_IMODE(stat.st_mode) != mode:
+                    os.chmod(path, mode)
+                return None
+        self.write(path, content, mode)
+        return "modified"
+
+    def replace_if_changed(self, source, dest):
+        """
+        Moves a file over another one, unless both hold the same content, in
+        which case the former is deleted and the latter left untouched (but
+        for its mode).
+
+        Returns: "modified", or None if the file was unchanged
+        """
+        if not filecmp.cmp(source, dest, shallow=False):
+            os.replace(source, dest)
+            return "modified"
+        self.chmod(dest, S_IMODE(os.stat(source).st_mode))
+        os.remove(source)
+        return None
+
+
+class _ArchiveSink:
+    """
+    Streams the folders and files of a web site into an archive, in place of
+    _FileSystem (see Builder.build's output).
+
+    Each file is spooled in memory (or in a temporary file past a few MiB)
+    until complete, and then appended to the archive as a member whose mode
+    is the file's, so that the web site's umasks survive its extraction.
+    Members are named after their path relative to the web site root.
+
+    Args:
+        path: path to the archive, str. Its extension picks the format:
+            .zip, .tar, .tar.gz (or .tgz), .tar.bz2, .tar.xz or .tar.zst
+        root: path to the web site root, str.
+        dir_mode: mode of the folders, Operating-system mode bitfield.
+        file_mode: default mode of the files, Operating-system mode bitfield.
+    """
+
+    shared = False  # Note: only the process which opened it can write to it
+    spool_size = 8 * 1024 * 1024
+    tar_modes: ClassVar[dict] = {
+        ".tar": "w|",
+        ".tar.gz": "w|gz",
+        ".tgz": "w|gz",
+        ".tar.bz2": "w|bz2",
+        ".tar.xz": "w|xz",
+    }
+
+    def __init__(self, path, root, dir_mode, file_mode):
+        self.path = path
+        self.root = root
+        self.dir_mode = dir_mode
+        self.file_mode = file_mode
+        self.mtime = time.time()
+        self.made = set()
+        self.sizes = {}
+        self.lock = threading.Lock()
+        self.zip = self.tar = None
+        extension = next(
+            (ext for ext in (*self.tar_modes, ".tar.zst", ".zip") if path.endswith(ext)),
+            None,
+        )
+        if extension is None:
+            msg = (
+                f"Unsupported archive '{path}'. Supported extensions: "
+                f"{', '.join((*self.tar_modes, '.tar.zst', '.zip'))}"
+            )
+            log.error(msg)
+            raise FlastikError(msg)
+        if extension == ".tar.zst":
+            try:
+                import zstandard
+            except ImportError:
+                msg = "The 'zstandard' package is required to build a .tar.zst archive."
+                log.error(msg)
+                raise FlastikError(msg) from None
+        parent = os.path.dirname(os.path.abspath(path))
+        os.makedirs(parent, exist_ok=True)
+        self.stack = ExitStack()
+        if extension == ".zip":
+            self.zip = self.stack.enter_context(
+                zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED)
+            )
+        elif extension == ".tar.zst":
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0))
+            compressor = zstandard.ZstdCompressor().stream_writer(os.fdopen(fd, "wb"))
+            self.stack.enter_context(compressor)
+            self.tar = self.stack.enter_context(
+                tarfile.TarFile.open(fileobj=compressor, mode="w|")
+            )
+        else:
+            self.tar = self.stack.enter_context(
+                tarfile.TarFile.open(path, self.tar_modes[extension])
+            )
+
+    def _member(self, path):
+        """Returns the name of a path's member, relative to the root"""
+        return os.path.relpath(path, self.root).replace(os.sep, "/")
+
+    def _add(self, name, mode, content=None, size=0):
+        """Appends a folder (content is None) or file member to the archive"""
+        with self.lock:
+            if self.zip is not None:
+                info = zipfile.ZipInfo(
+                    name + "/" if content is None else name,
+                    time.localtime(self.mtime)[:6],
+                )
+                if content is None:
+                    info.external_attr = (S_IFDIR | mode) << 16 | 0x10
+                    self.zip.writestr(info, b"")
+                    return
+                info.external_attr = (S_IFREG | mode) << 16
+                info.compress_type = zipfile.ZIP_DEFLATED
+                with self.zip.open(info, "w") as member:
+                    shutil.copyfileobj(content, member, 1024 * 1024)
+                return
+            info = tarfile.TarInfo(name)
+            info.mode = mode
+            info.mtime = self.mtime
+            if content is None:
+                info.type = tarfile.DIRTYPE
+            else:
+                info.size = size
+            self.tar.addfile(info, content)
+
+    def makedirs(self, path):
+        """Adds members for a folder and its missing parents, with dir_mode."""
+        missing = []
+        path = os.path.normpath(path)
+        while path not in self.made and self._member(path) != ".":
+            self.made.add(path)
+            missing.append(path)
+            path = os.path.dirname(path)
+        for folder in reversed(missing):
+            self._add(self._member(folder), self.dir_mode)
+
+    def chmod(self, path, mode):
+        """Members are added with their mode."""
+
+    def exists(self, path):
+        return path in self.sizes or path in self.made
+
+    def getsize(self, path):
+        return self.sizes[path]
+
+    def remove(self, path):
+        """Files failing half-way are never added, see open."""
+        self.sizes.pop(path, None)
+
+    @contextmanager
+    def open(self, path, mode=None, text=False):
+        """
+        Opens a file for writing, added to the archive with its mode once
+        closed (see _FileSystem.open)
+        """
+        if mode is None:
+            mode = self.file_mode
+        with tempfile.SpooledTemporaryFile(self.spool_size) as spool:
+            yield _TextSpool(spool) if text else spool
+            size = spool.tell()
+            spool.seek(0)
+            self._add(self._member(path), mode, spool, size)
+        self.sizes[path] = size
+
+    def write(self, path, data, mode=None):
+        """Adds data (str. or bytes) as a file member with its mode."""
+        with self.open(path, mode, text=isinstance(data, str)) as f:
+            f.write(data)
+
+    def copy(self, source, dest, mode=None):
+        """Adds a file's content as a file member with its mode."""
+        with open(source, "rb") as src, self.open(dest, mode) as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+
+    def write_if_changed(self, path, data, mode=None):
+        """Adds data as a file member, archives starting empty."""
+        self.write(path, data, mode)
+        return "added"
+
+    def close(self, discard=False):
+        """
+        Completes the archive, or deletes it if discard is True (e.g. the
+        build failed half-way)
+        """
+        try:
+            self.stack.close()
+        finally:
+            if discard and os.path.exists(self.path):
+                os.remove(self.path)
+
+
+class _TextSpool:
+    """Text writing interface of a binary spool (see _ArchiveSink.open)"""
+
+    def __init__(self, spool):
+        self.spool = spool
+
+    def write(self, text):
+        return self.spool.write(text.encode())
+
+
+class _PageWriter:
+    """
+    Background stage of Builder.build persisting the rendered pages while
+    the next ones are being rendered.
+
+    Pages are queued to a pool of threads through a bounded queue: when the
+    writers fall behind, submit() blocks until there is room again, which
+    caps the number of rendered pages held in memory.
+    Used as a context manager, it flushes every queued page on exit and
+    raises the error of the first page (in submission order) that could not
+    be written.
+    """
+
+    def __init__(self, write, writers=4, max_pending=None):
+        """
+        Args:
+            write: callable persisting one page, called with submit()'s args.
+
+        Keyword Args:
+            writers: number of writer threads, int. 0 writes synchronously.
+            max_pending: maximum number of queued pages, int.
+                Default value: 4 per writer thread.
+        """
+        if isinstance(writers, str):
+            writers = int(writers)
+        self.write = write
+        self.writers = writers or 0
+        self.queue = queue.Queue(maxsize=max_pending or 4 * self.writers)
+        self.threads = []
+        self.errors = []
+        self.lock = threading.Lock()
+        self.submitted = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # Note: an error raised while rendering takes precedence
+        self.close(check=exc_type is None)
+
+    def submit(self, label, *args):
+        """
+        Queues one page, blocking while the queue is full.
+
+        Args:
+            label: what is being written, for error messages, str.
+            *args: arguments of the 'write' callable.
+        """
+        if self.errors:
+            self.close()
+        index = self.submitted
+        self.submitted += 1
+        if not self.writers:
+            self._write(index, label, args)
+            return
+        # Note: threads are only started once there is something to write,
+        #       i.e. after the render workers, if any, have been forked.
+        if not self.threads:
+            for _ in range(self.writers):
+                thread = threading.Thread(target=self._run, daemon=True)
+                thread.start()
+                self.threads.append(thread)
+        self.queue.put((index, label, args))
+
+    def close(self, check=True):
+        """
+        Waits for every queued page to be written
+
+        Keyword Args:
+            check: boolean switch, bool.
+                If True (default): raises the first writing error, if any.
+        """
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        if check and self.errors:
+            _, label, err = min(self.errors, key=lambda error: error[0])
+            msg = f"Writing {label} failed: {err}"
+            log.error(msg)
+            raise FlastikError(msg) from err
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            self._write(*item)
+
+    def _write(self, index, label, args):
+        try:
+            self.write(*args)
+        except Exception as err:
+            with self.lock:
+                self.errors.append((index, label, err))
+
+
+# Render worker library (see Builder.build)
+_worker_builder = None
+
+
+def _init_render_worker(builder):
+    """Binds a freshly forked render worker to the Builder being built."""
+    global _worker_builder
+    _worker_builder = builder
+    Builder._rendering = builder
+
+
+def _render_in_worker(pages):
+    """
+    Renders a chunk of pages in a render worker
+
+    Args:
+        pages: view names and route variables, [(str., tuple),...]
+
+    Returns: for each page, what Builder._render_page returns, the static
+        files created while rendering, as (name, type, source, destination)
+        tuples, and the changes it made (see _ChangeSet)
+    """
+    results = []
+    changes = _worker_builder._changes.changes
+    for name, vv in pages:
+        registered = len(StaticFile.storage)
+        del changes[:]
+        try:
+            rendered = _worker_builder._render_page(
+                name, vv, stream=_worker_builder.fs.shared
+            )
+        except Exception:
+            # Note: tracebacks do not survive the trip back to the parent
+            msg = f"Rendering '{name}' {vv} failed:\n{traceback.format_exc()}"
+            log.error(msg)
+            raise FlastikError(msg) from None
+        new_statics = [
+            (record.name, record.type, record.source, record.destination)
+            for record in StaticFile.storage.since(registered)
+        ]
+        results.append((rendered, new_statics, list(changes)))
+    return results
+
+
+# Misc library
+def check_url_for_unsafe_characters(url):
+    unsafe = {'"', "<", ">", "#", "%", "{", "}", "|", "^", "~", "[", "]", "`", " "}
+    found = unsafe.intersection(set(url))
+    if found:
+        msg = "{} is an unsafe url.\n'{}' should not be used.".format(url, ", ".join(found))
+        log.error(msg)
+        raise FlastikError(msg)
+
+
+def check_path_for_illegal_characters(path):
+    unsafe = {".", '"', "[", "]", ":", ";", "|", "=", " ", "?", "$"}
+    found = unsafe.intersection(set(path))
+    if found:
+        msg = "{} is an illegal path.\n'{}' should not be used.".format(
+            path,
+            ", ".join(found),
+        )
+        log.error(msg)
+        raise FlastikError(msg)
+
+
+def apply_umasks(path, dir_umask, file_umask):
+    """
+    Applies both dir. and file umasks recursively all the way to destination path
+
+    Args:
+        path: destination path, str.
+        dir_umask: directory umask, Operating-system mode bitfield
+        file_umask: file umask, Operating-system mode bitfield
+    """
+    for root, dirs, files in os.walk(path):
+        os.chmod(root, dir_umask)
+        for d in dirs:
+            os.chmod(os.path.join(root, d), dir_umask)
+        for f in files:
+            os.chmod(os.path.join(root, f), file_umask)
+
+
+def add_Builder_arguments(arg_parser):
+    """
+    Adds all arguments related to the 'Builder' class to a given ArgumentParser instance
+    Returns an extended ArgumentParser instance
+
+    Args:
+        arg_parser: ArgumentParser instance
+
+    Returns: ArgumentParser instance
+    """
+    arg_parser.add_argument(
+        "--log_level",
+        dest="log_level",
         type=str,
         nargs="?",
         default="ERROR",
@@ -920,6 +3406,24 @@ def add_Builder_arguments(arg_parser):
         nargs="?",
         help=""" web site's author (meta info.), str.""",
     )
+    arg_parser.add_argument(
+        "--template_cache_dir",
+        dest="template_cache_dir",
+        type=str,
+        nargs="?",
+        help="""path to a folder caching compiled templates, str.
+                If None (default): templates are compiled by every run
+                Otherwise: compiled templates are reused by later runs""",
+    )
+    arg_parser.add_argument(
+        "--rst_cache_dir",
+        dest="rst_cache_dir",
+        type=str,
+        nargs="?",
+        help="""path to a folder caching RST conversions, str.
+                If None (default): RST files are converted by every run
+                Otherwise: conversions are reused by later runs""",
+    )
 
     return arg_parser
 
@@ -952,6 +3456,22 @@ def add_build_arguments(arg_parser):
         help="list of views to be built, [str.,...,str.] "
         "Note: All views are built by default.",
     )
+    arg_parser.add_argument(
+        "--routes",
+        dest="routes",
+        type=str,
+        nargs="+",
+        help="glob patterns of the pages to be built, [str.,...,str.] "
+        "Ex.: 'cruise/2021/*'. All pages are built by default.",
+    )
+    arg_parser.add_argument(
+        "--where",
+        dest="where",
+        type=str,
+        nargs="+",
+        help="values of route variables the pages to be built take, "
+        "[name=value,...,name=value] Ex.: year=2021 year=2022",
+    )
     arg_parser.add_argument(
         "--do_not_overwrite",
         dest="overwrite",
@@ -992,6 +3512,85 @@ def add_build_arguments(arg_parser):
         "Default value: 0o755, Operating-system "
         "mode bitfield.",
     )
+    arg_parser.add_argument(
+        "--jobs",
+        dest="jobs",
+        type=int,
+        nargs="?",
+        default=1,
+        help="number of processes rendering the pages, int. "
+        "Default value: 1. Use 0 for one process per CPU.",
+    )
+    arg_parser.add_argument(
+        "--writers",
+        dest="writers",
+        type=int,
+        nargs="?",
+        default=4,
+        help="number of threads writing the *.html files, int. "
+        "Default value: 4. Use 0 to write each page as soon as "
+        "it is rendered.",
+    )
+    arg_parser.add_argument(
+        "--incremental",
+        dest="incremental",
+        default=False,
+        action="store_true",
+        help="If one uses this option, only the pages whose view, route "
+        "variables or templates changed since the previous incremental "
+        "build are rendered, and pages of removed routes are deleted.",
+    )
+    arg_parser.add_argument(
+        "--minify",
+        dest="minify",
+        default=False,
+        action="store_true",
+        help="If one uses this option, whitespace and comments are squeezed "
+        "out of the *.html files and of the style sheet.",
+    )
+    arg_parser.add_argument(
+        "--precompress",
+        dest="precompress",
+        default=False,
+        action="store_true",
+        help="If one uses this option, a gzip compressed copy (*.gz) is "
+        "written next to each page and text static file of 1 KiB or more "
+        "that compresses.",
+    )
+    arg_parser.add_argument(
+        "--report",
+        dest="report",
+        type=str,
+        nargs="?",
+        help="path to a JSON build report, str. A Prometheus text file is "
+        "saved next to it, with a '.prom' extension.",
+    )
+    arg_parser.add_argument(
+        "--watch",
+        dest="watch",
+        default=False,
+        action="store_true",
+        help="If one uses this option, the web site is built and then "
+        "rebuilt whenever its templates, RST files or static files change, "
+        "until interrupted (see Builder.watch).",
+    )
+    arg_parser.add_argument(
+        "--output",
+        dest="output",
+        type=str,
+        nargs="?",
+        help="path to an archive (.zip, .tar, .tar.gz, .tar.bz2, .tar.xz or "
+        ".tar.zst) the web site and its static files are streamed into, "
+        "instead of being written to --dest, str.",
+    )
+    arg_parser.add_argument(
+        "--change_set",
+        dest="change_set",
+        type=str,
+        nargs="?",
+        help="path to a JSON file listing the files the build added, "
+        "modified and removed, relative to --dest, str.",
+    )
     return arg_parser
 
 
@@ -1009,18 +3608,117 @@ def rst2html(rst_file, **context):
 
     Returns: rendered HTML, str.
     """
+    builder = Builder.current()
+    builder._depends_on(rst_file)
     with open(rst_file) as f:
         rst_string = f.read()
     # Convert rst to html5
+    # Note: conversions are cached per RST content (see Builder's
+    #       rst_cache_dir and preload_rst), and so are the templates compiled
+    #       from them.
+    html_string = builder._rst_to_html(rst_string)
+    # Use Jinja variables and logics
+    str_template = builder._rst_template(html_string)
+
+    return str_template.render(**context)
+
+
+# Elements of a page minification leaves alone, comments and whitespace runs
+_HTML_TOKENS = re.compile(
+    r"(?P<keep><(?P<raw>pre|textarea|script|style)\b.*?</(?P=raw)\s*>|<!--\[if.*?-->|<!--!.*?-->)"
+    r"|(?P<comment>\s*(?:<!--(?!\[if|!).*?-->\s*)+)"
+    r"|(?P<tag><[^>]*>)"
+    r"|(?P<space>\s+)",
+    re.DOTALL | re.IGNORECASE,
+)
+_HTML_COMMENTS = re.compile(r"<!--.*?-->", re.DOTALL)
+# Strings and comments of a style sheet, the ones to keep being captured
+_CSS_TOKENS = re.compile(
+    r"(\"(?:\\.|[^\"\\])*\"|'(?:\\.|[^'\\])*'|/\*!.*?\*/)|/\*.*?\*/", re.DOTALL
+)
+_CSS_SPACES = re.compile(r"\s+")
+_CSS_PUNCTUATION = re.compile(r"\s*([{};,>])\s*")
+_CSS_COLON = re.compile(r"\s*:\s*")
+_CSS_BLOCK_PUNCTUATION = re.compile(r"[{};]")
+
+
+def _minify_html(html):
+    """
+    Squeezes comments and whitespace runs out of html: runs spanning lines
+    become one line break, the others one space, which browsers render the
+    same. Comments are dropped, and the whitespace around them squeezed the
+    same way (e.g. 'a <!-- b --> c' becomes 'a c'). Tags, conditional
+    comments, comments starting with '<!--!' and <pre>, <textarea>, <script>
+    and <style> elements are left untouched.
+
+    Returns: minified html, str.
+    """
+
+    def replace(match):
+        space = match.group("space")
+        if match.group("comment") is not None:
+            space = _HTML_COMMENTS.sub("", match.group("comment"))
+            if not space:
+                return ""
+        if space is not None:
+            return "\n" if "\n" in space else " "
+        return match.group(0)
+
+    return _HTML_TOKENS.sub(replace, html).strip()
+
+
+def _minify_css(css):
+    """
+    Squeezes comments (but the ones starting with '/*!') and whitespace out
+    of a style sheet, leaving strings untouched. Whitespace around the colons
+    of declarations goes too, but not before the colons of selectors, where
+    it is a descendant combinator (e.g. 'a :hover').
+
+    Returns: minified style sheet, str.
+    """
+
+    def squeeze(start, end):
+        def colon(match):
+            # Note: selectors are followed by a block, declarations end with
+            #       ';' or '}'
+            after = _CSS_BLOCK_PUNCTUATION.search(css, start + match.end())
+            return match.group(0) if after is not None and after.group(0) == "{" else ":"
+
+        text = _CSS_COLON.sub(colon, css[start:end])
+        text = _CSS_PUNCTUATION.sub(r"\1", _CSS_SPACES.sub(" ", text))
+        return text.replace(";}", "}")
+
+    parts = []
+    position = 0
+    for match in _CSS_TOKENS.finditer(css):
+        parts.append(squeeze(position, match.start()))
+        if match.group(1) is not None:
+            parts.append(match.group(1))
+        position = match.end()
+    parts.append(squeeze(position, len(css)))
+    return "".join(parts).strip()
+
+
+def _rst_key(rst_string):
+    """Returns the cache key of an RST conversion, str."""
+    return hashlib.sha1(f"{_RST_SETTINGS}\0{rst_string}".encode()).hexdigest()
+
+
+def _convert_rst(rst_string):
+    """
+    Converts RST to html with docutils
+
+    Args:
+        rst_string: RST, str.
+
+    Returns: html body, Jinja tags included, str.
+    """
+    # Convert rst to html5
     html_string = publish_parts(rst_string, writer="html5")["html_body"]
     # Restore Jinja injections
     html_string = html_string.replace("<p>{{", "{{").replace("}}</p>", "}}")
     html_string = html_string.replace("<p>{%", "{%").replace("%}</p>", "%}")
-    # Use Jinja variables and logics
-    jinja_env = Builder.current().jinja_env
-    str_template = jinja_env.from_string(html_string)
-
-    return str_template.render(**context)
+    return html_string
 
 
 # Flask-lookalikes Library
@@ -1040,19 +3738,127 @@ def render_template(template_name, **context):
     return template.render(**context)
 
 
+def stream_template(template_name, **context):
+    """
+    Flask-lookalike templating function.
+    Renders given template as a stream: views returning it have their page
+    written to file chunk by chunk as it is rendered, rather than rendered to
+    a string first, which keeps very large pages out of memory.
+
+    Args:
+        template_name: template name, str
+        **context: dictionary of templating variables, dict.
+          Ex.: context = {'var_name_1': var_val_1,...,'var_name_N': var_val_N}
+
+    Returns: TemplateStream
+    """
+    jinja_env = Builder.current().jinja_env
+    # Get template through jinja template env/loader
+    template = jinja_env.get_template(template_name)
+    return template.stream(**context)
+
+
+class _StaticRecord:
+    """What StaticFile.storage knows of one static file."""
+
+    __slots__ = ("builder", "destination", "name", "source", "type")
+
+    def __init__(self, name, type, source, destination, builder):
+        self.name = name
+        self.type = type
+        self.source = source
+        self.destination = destination
+        self.builder = builder
+
+    def __repr__(self):
+        return f"_StaticRecord({self.name!r}, {self.type!r}, {self.source!r}, {self.destination!r})"
+
+
+class _StaticStorage:
+    """
+    Registry of the static files, keyed on (builder, type, destination).
+
+    Records are also indexed by web site, source and destination, which keeps
+    registration, duplicate checks and look-ups constant time however many
+    static files there are. Indexing with a column name, e.g.
+    storage["builder"], lists that column in registration order.
+
+    Note: files created before any Builder existed are recorded under None
+          and belong to every web site.
+    """
+
+    columns = ("name", "type", "source", "destination", "builder")
+
+    def __init__(self):
+        self.records = {}
+        self.order = []
+        self.by_builder = {}
+        self.by_source = {}
+        self.by_destination = {}
+
+    def add(self, record):
+        """Registers a static file's record, _StaticRecord."""
+        self.records[(record.builder, record.type, record.destination)] = record
+        self.order.append(record)
+        self.by_builder.setdefault(record.builder, []).append(record)
+        self.by_source.setdefault(record.source, []).append(record)
+        self.by_destination.setdefault((record.type, record.destination), []).append(record)
+
+    def of(self, builder):
+        """Returns the records of a web site's static files, list."""
+        if builder is None:
+            return list(self.by_builder.get(None, ()))
+        return self.by_builder.get(builder, []) + self.by_builder.get(None, [])
+
+    def with_source(self, source, builder):
+        """Returns the records of a web site's static files made from 'source', list."""
+        return [
+            record
+            for record in self.by_source.get(source, ())
+            if record.builder is builder or record.builder is None
+        ]
+
+    def with_destination(self, type, destination, builder):
+        """Returns the records of a web site's static files deployed to type/destination, list."""
+        return [
+            record
+            for record in self.by_destination.get((type, destination), ())
+            if record.builder is builder or record.builder is None
+        ]
+
+    def since(self, count):
+        """Returns the records registered after the first 'count' ones, list."""
+        return self.order[count:]
+
+    def clear(self):
+        self.records.clear()
+        self.order.clear()
+        self.by_builder.clear()
+        self.by_source.clear()
+        self.by_destination.clear()
+
+    def __getitem__(self, column):
+        if column not in self.columns:
+            raise KeyError(column)
+        return [getattr(record, column) for record in self.order]
+
+    def __contains__(self, key):
+        return key in self.records
+
+    def __iter__(self):
+        return iter(self.order)
+
+    def __len__(self):
+        return len(self.order)
+
+
 # Library for "static files"...as in other files than html and bootstrap related
 class StaticFile:
-    # Storage container for aggregating static file info
+    # Storage container for aggregating static file info (see _StaticStorage)
     # Note: 'builder' records the web site each file belongs to, so that two
     #       Builders neither collide with nor collect each other's statics.
     #       It is None for files created before any Builder existed.
-    storage: ClassVar[dict] = {
-        "name": [],
-        "type": [],
-        "source": [],
-        "destination": [],
-        "builder": [],
-    }
+    storage: ClassVar[_StaticStorage] = _StaticStorage()
     # Sub-folder of the web site root this kind of static file is deployed to.
     # Note: subclasses override it, which is what keeps their destinations in
     #       separate namespaces (see the duplicate check in __init__).
@@ -1109,14 +3915,7 @@ class StaticFile:
         #       underneath, so two files only clash when both match. E.g. an
         #       Image and a Download may both be named 'logo.png', and so may
         #       the Images of two different Builders.
-        taken = set(
-            zip(
-                self.storage["builder"],
-                self.storage["type"],
-                self.storage["destination"], strict=False,
-            )
-        )
-        if (self.builder, self.type, filename) not in taken:
+        if not self._is_taken(self.builder, self.type, filename):
             self.destination = filename
         else:
             if handle_duplicate:  # define unique subfolder
@@ -1129,11 +3928,36 @@ class StaticFile:
                 raise FlastikError(msg)
         log.info("File Name & Destination: %s & %s", filename, self.destination)
         # - aggregating static file info
-        self.storage["name"].append(name)
-        self.storage["source"].append(source)
-        self.storage["destination"].append(self.destination)
-        self.storage["type"].append(self.type)
-        self.storage["builder"].append(self.builder)
+        self._register(
+            name, self.type, source, self.destination, builder=self.builder, check=False
+        )
+
+    @classmethod
+    def _is_taken(cls, builder, type, destination):
+        """
+        Tells whether a destination is already used by a static file of the
+        same type and web site.
+
+        Returns: bool
+        """
+        return (builder, type, destination) in cls.storage
+
+    @classmethod
+    def _register(cls, name, type, source, destination, builder=None, check=True):
+        """
+        Aggregates a static file's info in the storage container
+
+        Note: also used to adopt the static files created by the views while
+              rendering in another process (see Builder.build), hence the
+              duplicate check unless the caller did it already.
+        """
+        if check and cls._is_taken(builder, type, destination):
+            msg = (
+                f"{os.path.join(type, destination)} is already in use. Change source name or destination using the 'dest' option"
+            )
+            log.error(msg)
+            raise FlastikError(msg)
+        cls.storage.add(_StaticRecord(name, type, source, destination, builder))
 
     @property
     def url(self):
@@ -1149,9 +3973,10 @@ class StaticFile:
             )
             log.error(msg)
             raise FlastikError(msg)
+        self.builder._depends_on(self.source)
         # - make relative path to where it got called
         dest = os.path.join(self.type, self.destination)
-        relative_path = os.path.relpath(dest, self.builder.current_route)
+        relative_path = self.builder._relative_url(dest)
         log.debug("staticfile relative path: %s", relative_path)
         return relative_path
 
@@ -1243,6 +4068,11 @@ def collect_static_files(
     file_umask=0o644,
     folder_umask=0o755,
     builder=None,
+    dedupe=False,
+    hard_link=False,
+    writers=4,
+    precompress=False,
+    precompress_min_size=1024,
     **kwargs,
 ):
     """
@@ -1263,6 +4093,27 @@ def collect_static_files(
           If None (default): the current Builder is used (see Builder.current).
           Only relevant to projects building several web sites in one go, which
           should collect each site's statics right after building it.
+        dedupe: boolean switch, bool.
+          If True: static files whose sources have the same content are only
+            copied once, the other ones being hard links to that copy (or
+            copies where hard links are not supported). Only relevant when
+            copying locally.
+          If False (default): every static file is copied separately.
+        hard_link: boolean switch, bool.
+          If True: static files will be hard links to their sources (or
+            copies where hard links are not supported), unless copied locally
+          If False (default): symlinks will be used, unless copied locally
+        writers: number of threads deploying static files, int.
+        precompress: boolean switch, bool.
+          If True: a gzip compressed copy is written next to each text static
+            file (e.g. .txt, .css, .js, .svg) at least precompress_min_size
+            bytes large (see Builder.build)
+          If False (default): it isn't
+        precompress_min_size: see precompress, int. Default value: 1024.
+
+    Note: static files already up to date (right symlink or hard link, or
+          copy with the source's size, modification time and permissions)
+          are left untouched.
     """
     # Sanity check
     if isinstance(file_umask, str):
@@ -1281,46 +4132,273 @@ def collect_static_files(
         )
         log.error(msg)
         raise FlastikError(msg)
-    elif not static_root:  # Note: user specified dest takes over
-        static_root = Builder.current().dest
-
     if builder is None and Builder.instance:
         builder = Builder.current()
+    if not static_root:  # Note: user specified dest takes over
+        static_root = builder.dest
     selected = [
-        (src, dst, tp)
-        for src, dst, tp, owner in zip(
-            StaticFile.storage["source"],
-            StaticFile.storage["destination"],
-            StaticFile.storage["type"],
-            StaticFile.storage["builder"], strict=False,
-        )
-        if owner is builder or owner is None
+        (record.source, record.destination, record.type)
+        for record in StaticFile.storage.of(builder)
     ]
     if not selected:
         print("There is no static files to collect")
         return
+    # - Find the static files sharing the content of an earlier one
+    originals = {}
+    if dedupe and (copy_locally or hard_link):
+        digests = _content_digests([src for src, _, _ in selected])
+        first_copies = {}
+        for src, dst, tp in selected:
+            dst = os.path.join(static_root, tp, dst)
+            # Note: files of unique size are not hashed, but the same source
+            #       is still a duplicate of itself
+            key = digests[src] or os.path.abspath(src)
+            original = first_copies.setdefault(key, dst)
+            if original != dst:
+                originals[dst] = original
+        log.info("%s static files are duplicates", len(originals))
     # File Management Strategy
     # - Make folder architecture
+    if copy_locally:
+        mode = "copy"
+    elif hard_link:
+        mode = "hardlink"
+    else:
+        mode = "symlink"
+    transfers = []
+    duplicates = []
+    fs = _FileSystem(folder_umask, file_umask)
     for src, dst, tp in selected:
         # - making separated folder for Image, Download and StaticFile instances
         dst = os.path.join(static_root, tp, dst)
-        dir_name = os.path.dirname(dst)
-        if dir_name and not os.path.exists(dir_name):
-            os.makedirs(dir_name, folder_umask)
-        # - Make symlink to (or copy) source files in their dest. location
-        #     Note: symlinks require a certain server/file system set-up
-        if os.path.exists(dst) and not overwrite_static:
+        fs.makedirs(os.path.dirname(dst))
+        if os.path.lexists(dst) and not overwrite_static:
             continue
-        elif os.path.exists(dst) and overwrite_static:
-            os.remove(dst)
-        if not copy_locally:
-            log.info("Creating Symlink from %s to %s", src, dst)
-            os.symlink(src, dst)
+        if dst in originals:
+            duplicates.append((originals[dst], dst))
         else:
-            log.info("Copying from %s to %s", src, dst)
-            shutil.copy(src, dst)
-            log.info("Applying '%s' umask to %s", file_umask, dst)
-            os.chmod(dst, file_umask)
+            transfers.append((src, dst))
+    # - Make symlinks to (or copies of) source files in their dest. location,
+    #   skipping the ones already up to date
+    #     Note: symlinks require a certain server/file system set-up
+    #     Note: duplicates are linked once their originals are in place
+    deployed = 0
+    with ThreadPoolExecutor(max_workers=int(writers) or None) as executor:
+        for pairs, pair_mode in ((transfers, mode), (duplicates, "hardlink")):
+            deployed += sum(
+                executor.map(
+                    lambda pair, pair_mode=pair_mode: _deploy_static_file(
+                        *pair, pair_mode, file_umask
+                    ),
+                    pairs,
+                )
+            )
+    log.info(
+        "Deployed %s static files, %s were up to date",
+        deployed,
+        len(transfers) + len(duplicates) - deployed,
+    )
+    # - Precompress text static files
+    if precompress:
+        compressed = _precompress(
+            (os.path.join(static_root, tp, dst) for _, dst, tp in selected),
+            precompress_min_size,
+        )
+        log.info("Compressed %s static files", compressed)
+
+
+def _deploy_static_file(source, dest, mode, file_umask):
+    """
+    Deploys a static file, unless it is already up to date. The file is
+    made next to its destination and then moved over it, so that the web
+    site never serves a partial file.
+
+    Args:
+        source: path to source, str.
+        dest: path to destination, str.
+        mode: "symlink", "copy" or "hardlink" (which copies where hard links
+          are not supported), str.
+        file_umask: u-mask for copied files, Operating-system mode bitfield.
+
+    Returns: whether the file was deployed, bool.
+    """
+    if _is_deployed(source, dest, mode, file_umask):
+        return False
+    temp = os.path.join(os.path.dirname(dest), f".{os.path.basename(dest)}.{uuid4().hex}")
+    try:
+        if mode == "symlink":
+            log.info("Creating Symlink from %s to %s", source, dest)
+            os.symlink(source, temp)
+        elif mode == "hardlink" and _hard_link(source, temp):
+            log.info("Linking %s to %s", dest, source)
+        else:
+            log.info("Copying from %s to %s", source, dest)
+            _copy_file(source, temp)
+            log.info("Applying '%s' umask to %s", file_umask, dest)
+            os.chmod(temp, file_umask)
+        os.replace(temp, dest)
+    except BaseException:
+        if os.path.lexists(temp):
+            os.remove(temp)
+        raise
+    return True
+
+
+def _is_deployed(source, dest, mode, file_umask):
+    """
+    Tells whether a static file's destination is up to date: the right
+    symlink, a hard link to the source, or a copy with the source's size and
+    modification time and the expected permissions.
+
+    Returns: bool
+    """
+    try:
+        dest_stat = os.lstat(dest)
+    except FileNotFoundError:
+        return False
+    if mode == "symlink":
+        return S_ISLNK(dest_stat.st_mode) and os.readlink(dest) == source
+    source_stat = os.stat(source)
+    if mode == "hardlink" and os.path.samestat(dest_stat, source_stat):
+        return True
+    return (
+        S_ISREG(dest_stat.st_mode)
+        and dest_stat.st_size == source_stat.st_size
+        and dest_stat.st_mtime_ns == source_stat.st_mtime_ns
+        and S_IMODE(dest_stat.st_mode) == file_umask
+    )
+
+
+def _copy_file(source, dest):
+    """
+    Copies a file's content and times. The copy is a clone sharing the
+    source's blocks where the file system supports it (e.g. Btrfs, XFS), and
+    is otherwise left to shutil, which uses the kernel's zero-copy calls.
+    """
+    if not _clone_file(source, dest):
+        shutil.copyfile(source, dest)
+    shutil.copystat(source, dest)
+
+
+def _clone_file(source, dest):
+    """
+    Clones a file (FICLONE ioctl, Linux only).
+
+    Returns: True if done, False if not supported, bool.
+    """
+    if fcntl is None:
+        return False
+    with open(source, "rb") as src, open(dest, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+        except OSError:
+            return False
+    return True
+
+
+def _precompress(paths, min_size=1024):
+    """
+    Writes a gzip compressed copy of each text file next to it (path + '.gz'),
+    across a pool of threads (zlib lets them compress in parallel).
+
+    Args:
+        paths: paths to files, iterable. Files whose extension is not one of
+            _COMPRESSIBLE are skipped.
+        min_size: files smaller than this number of bytes are skipped, int.
+
+    Returns: number of files compressed, int.
+    """
+    paths = (
+        path for path in paths if os.path.splitext(path)[1].lower() in _COMPRESSIBLE
+    )
+    compressed = 0
+    with ThreadPoolExecutor() as executor:
+        # Note: handed out by batches, paths may be a lazy generator
+        while batch := list(itertools.islice(paths, 1024)):
+            compressed += sum(
+                executor.map(lambda path: _gzip_file(path, min_size), batch)
+            )
+    return compressed
+
+
+def _gzip_file(path, min_size):
+    """
+    Writes a gzip compressed copy of a file next to it, unless the file is
+    smaller than min_size bytes, does not compress or did not change since
+    its copy was made (the copy gets the file's modification time).
+
+    Returns: whether the file was compressed, bool.
+    """
+    gz_path = path + ".gz"
+    stat = os.stat(path)
+    try:
+        if os.stat(gz_path).st_mtime_ns == stat.st_mtime_ns:
+            return False
+    except FileNotFoundError:
+        pass
+    compressed = None
+    if stat.st_size >= min_size:
+        with open(path, "rb") as f:
+            data = f.read()
+        # Note: mtime=0 keeps the copy identical from one build to the next
+        compressed = gzip.compress(data, compresslevel=9, mtime=0)
+        if len(compressed) >= len(data):
+            compressed = None
+    if compressed is None:
+        if os.path.isfile(gz_path):  # outdated copy
+            os.remove(gz_path)
+        return False
+    temp = f"{gz_path}.{uuid4().hex}"
+    with open(temp, "wb") as f:
+        f.write(compressed)
+    os.chmod(temp, S_IMODE(stat.st_mode))
+    os.utime(temp, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    os.replace(temp, gz_path)
+    return True
+
+
+def _content_digests(paths, chunk_size=1024 * 1024):
+    """
+    Hashes the content of the files which may have a twin, that is the ones
+    sharing their size with another file, in parallel and by chunks.
+
+    Args:
+        paths: paths to files, list
+
+    Returns: {path: digest or None} dict, None for files of unique size
+    """
+    paths = list(dict.fromkeys(paths))
+    sizes = {path: os.path.getsize(path) for path in paths}
+    size_counts = {}
+    for size in sizes.values():
+        size_counts[size] = size_counts.get(size, 0) + 1
+
+    def digest(path):
+        sha = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                sha.update(chunk)
+        return f"{sizes[path]}:{sha.hexdigest()}"
+
+    candidates = [path for path in paths if size_counts[sizes[path]] > 1]
+    digests = dict.fromkeys(paths)
+    with ThreadPoolExecutor() as executor:
+        digests.update(zip(candidates, executor.map(digest, candidates), strict=True))
+    return digests
+
+
+def _hard_link(source, dest):
+    """
+    Hard links dest to source.
+
+    Returns: True if done, False if the file system does not support it, bool.
+    """
+    try:
+        os.link(source, dest)
+    except OSError as error:
+        log.debug("Could not link %s to %s: %s", dest, source, error)
+        return False
+    return True
 
 
 def add_collect_static_files_arguments(arg_parser):
@@ -1377,4 +4455,22 @@ def add_collect_static_files_arguments(arg_parser):
         help="""u-mask for static folders, Operating-system mode bitfield.
                             \nDefault value = 0o755""",
     )
+    arg_parser.add_argument(
+        "--dedupe",
+        dest="dedupe",
+        default=False,
+        action="store_true",
+        help="If one uses this option along with --copy_locally, static "
+        "files with identical content are copied once and hard linked "
+        "elsewhere",
+    )
+    arg_parser.add_argument(
+        "--hard_link",
+        dest="hard_link",
+        default=False,
+        action="store_true",
+        help="If one uses this option, static files are hard links to their "
+        "sources (copies where hard links are not supported) rather than "
+        "symlinks",
+    )
     return arg_parser
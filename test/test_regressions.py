@@ -8,15 +8,20 @@ test_flastik.py does not exercise. Each test here stands on its own: the
 Builder and StaticFile keep, so these can be run individually and in any
 order.
 """
+import gzip
+import json
 import logging
 import os
 import sys
+import threading
+from urllib.error import HTTPError
+from urllib.request import urlopen
 
 import pytest
 
 import flastik
 from flastik import Builder, Download, Image, cli, collect_static_files, render_template
-from flastik.flastik import StaticFile
+from flastik.flastik import StaticFile, _minify_css, _minify_html
 
 PACKAGE_PATH = os.path.dirname(os.path.abspath(flastik.__file__))
 ICON = os.path.join(PACKAGE_PATH, "base_templates", "default_icon.png")
@@ -30,8 +35,7 @@ def reset_state():
     """
     Builder.instance.clear()
     Builder._rendering = None
-    for values in StaticFile.storage.values():
-        values.clear()
+    StaticFile.storage.clear()
     log = logging.getLogger("flastik.flastik")
     for handler in list(log.handlers):
         log.removeHandler(handler)
@@ -329,3 +333,1039 @@ def test_escape_doc_handles_undocumented_objects():
 
     assert cli.escape_doc(Sample.documented) == "Takes a &lt;list&gt; of things."
     assert cli.escape_doc(Sample.undocumented) == ""
+
+
+# Parallel rendering
+def make_numbered_site(count=12):
+    website = Builder()
+
+    @website.route("/home.html")
+    def home():
+        return f"<a href='{website.url_for('numbered', number=0)}'>first</a>"
+
+    @website.route("/pages/<int:number>/", number=list(range(count)))
+    def numbered(number):
+        return f"page {number}, home at {website.url_for('home')}"
+
+    return website
+
+
+def read_tree(root):
+    tree = {}
+    for folder, _, files in os.walk(root):
+        for name in files:
+            path = os.path.join(folder, name)
+            with open(path, "rb") as f:
+                tree[os.path.relpath(path, root)] = f.read()
+    return tree
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="requires the 'fork' start method")
+def test_parallel_build_matches_serial_build(tmp_path):
+    website = make_numbered_site()
+    website.build(dest=str(tmp_path / "serial"))
+    website.build(dest=str(tmp_path / "parallel"), jobs=3)
+
+    serial = read_tree(tmp_path / "serial")
+    assert serial == read_tree(tmp_path / "parallel")
+    assert serial[os.path.join("pages", "7", "index.html")] == b"page 7, home at ../../home.html"
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="requires the 'fork' start method")
+def test_parallel_build_reports_the_failing_page(tmp_path):
+    website = Builder()
+
+    @website.route("/<int:number>/", number=[1, 2, 3, 4])
+    def fragile(number):
+        if number == 3:
+            raise ValueError("no page three")
+        return str(number)
+
+    with pytest.raises(flastik.FlastikError, match=r"(?s)'fragile' \(3,\).*no page three"):
+        website.build(dest=str(tmp_path / "site"), jobs=2)
+    assert Builder._rendering is None
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="requires the 'fork' start method")
+def test_statics_created_by_parallel_views_are_collected(tmp_path):
+    website = Builder()
+
+    @website.route("/<string:ship>/", ship=["ariel", "bounty"])
+    def ship_page(ship):
+        return Image(ship, ICON, dest=f"{ship}.png").html_image
+
+    website.build(dest=str(tmp_path / "site"), jobs=2)
+    collect_static_files(copy_locally=True)
+
+    assert sorted(os.listdir(tmp_path / "site" / "images")) == ["ariel.png", "bounty.png"]
+
+
+# Background writers
+@pytest.mark.parametrize("writers", [0, 1, 4])
+def test_every_page_is_written_before_build_returns(tmp_path, writers):
+    website = make_numbered_site(count=50)
+    website.build(dest=str(tmp_path / "site"), writers=writers)
+
+    pages = read_tree(tmp_path / "site" / "pages")
+    assert len(pages) == 50
+    assert pages[os.path.join("49", "index.html")] == b"page 49, home at ../../home.html"
+
+
+def test_first_write_error_is_reported_by_build(tmp_path):
+    website = make_numbered_site(count=20)
+    # A folder where page 3 should go makes writing it fail
+    (tmp_path / "site" / "pages" / "3" / "index.html").mkdir(parents=True)
+    (tmp_path / "site" / "pages" / "8" / "index.html").mkdir(parents=True)
+
+    with pytest.raises(flastik.FlastikError, match=r"Writing pages/3/index\.html failed"):
+        website.build(dest=str(tmp_path / "site"), writers=4)
+
+
+# Incremental builds
+def make_counting_site(templates, calls, ships=("ariel", "bounty")):
+    website = Builder(template_dirs=str(templates))
+
+    @website.route("/<string:ship>/", ship=list(ships))
+    def ship_page(ship):
+        calls.append(ship)
+        return render_template("ship.html", ship=ship)
+
+    return website
+
+
+def test_incremental_build_only_renders_changed_pages(tmp_path):
+    templates = tmp_path / "templates"
+    templates.mkdir()
+    (templates / "ship.html").write_text("{% include 'name.html' %}")
+    (templates / "name.html").write_text("ship {{ ship }}")
+    site = tmp_path / "site"
+    calls = []
+
+    make_counting_site(templates, calls).build(dest=str(site), incremental=True)
+    assert calls == ["ariel", "bounty"]
+    assert (site / ".flastik" / "manifest.json").is_file()
+
+    calls.clear()
+    make_counting_site(templates, calls).build(dest=str(site), incremental=True)
+    assert calls == []
+
+    # Included templates are part of a page's inputs
+    (templates / "name.html").write_text("vessel {{ ship }}")
+    make_counting_site(templates, calls).build(dest=str(site), incremental=True)
+    assert calls == ["ariel", "bounty"]
+    assert (site / "ariel" / "index.html").read_text() == "vessel ariel"
+
+
+def test_incremental_build_completes_the_progress_bar(tmp_path, capsys):
+    templates = tmp_path / "templates"
+    templates.mkdir()
+    (templates / "ship.html").write_text("ship {{ ship }}")
+    site = tmp_path / "site"
+    make_counting_site(templates, []).build(dest=str(site), incremental=True)
+    capsys.readouterr()
+
+    make_counting_site(templates, []).build(dest=str(site), incremental=True)
+    bar = capsys.readouterr().out.split("\r")[-1]
+    done, total = bar.split()[-1].split("/")
+    assert done == total and bar.endswith("\n")
+
+def test_incremental_build_renders_missing_pages_and_removes_stale_ones(tmp_path):
+    templates = tmp_path / "templates"
+    templates.mkdir()
+    (templates / "ship.html").write_text("ship {{ ship }}")
+    site = tmp_path / "site"
+    calls = []
+
+    make_counting_site(templates, calls).build(dest=str(site), incremental=True)
+    os.remove(site / "ariel" / "index.html")
+
+    calls.clear()
+    make_counting_site(templates, calls, ships=["ariel"]).build(
+        dest=str(site), incremental=True)
+    assert calls == ["ariel"]
+    assert (site / "ariel" / "index.html").is_file()
+    assert not (site / "bounty").exists()
+
+
+# Dependency graph
+def test_dependencies_record_templates_rst_and_statics(tmp_path):
+    rst = tmp_path / "text.rst"
+    rst.write_text("Some *text*")
+    website = Builder()
+    image = Image("logo", ICON)
+
+    @website.route("/index.html")
+    def home():
+        return render_template(
+            "test.html", body_text=flastik.rst2html(str(rst)), img=image, footer_link={})
+
+    @website.route("/plain.html")
+    def plain():
+        return "no templates"
+
+    website.build(dest=str(tmp_path / "site"))
+
+    graph = website.dependencies()
+    templates = os.path.join(PACKAGE_PATH, "base_templates")
+    assert graph["plain.html"] == []
+    assert graph["index.html"] == sorted([
+        os.path.join(templates, name)
+        for name in ("test.html", "base.html", "navbar.html", "footer.html")
+    ] + [str(rst), ICON])
+    assert website.dependencies(os.path.join(templates, "footer.html")) == ["index.html"]
+
+
+def test_build_with_changed_files_only_renders_dependent_pages(tmp_path):
+    templates = tmp_path / "templates"
+    templates.mkdir()
+    (templates / "ship.html").write_text("ship {{ ship }}")
+    (templates / "other.html").write_text("other")
+    calls = []
+    website = make_counting_site(templates, calls)
+
+    @website.route("/other.html")
+    def other():
+        calls.append("other")
+        return render_template("other.html")
+
+    website.build(dest=str(tmp_path / "site"))
+    calls.clear()
+    website.build(dest=str(tmp_path / "site"), changed=[str(templates / "other.html")])
+    assert calls == ["other"]
+
+    # A fresh Builder picks the graph up from an incremental build's manifest
+    website.build(dest=str(tmp_path / "site"), incremental=True)
+    calls.clear()
+    fresh = make_counting_site(templates, calls)
+    fresh.build(dest=str(tmp_path / "site"), changed=[str(templates / "other.html")])
+    assert calls == []
+    fresh.build(dest=str(tmp_path / "site"), changed=[str(templates / "ship.html")])
+    assert calls == ["ariel", "bounty"]
+
+
+# Template bytecode cache
+def test_compiled_templates_are_cached_per_search_path(tmp_path):
+    cache = tmp_path / "cache"
+    templates = tmp_path / "templates"
+    templates.mkdir()
+    (templates / "page.html").write_text("version 1")
+
+    first = Builder(template_dirs=str(templates), template_cache_dir=str(cache))
+    first.jinja_env.get_template("page.html")
+    cached = os.listdir(cache)
+    assert len(cached) == 1
+
+    # Another search path does not share the cache entries
+    other = Builder(template_dirs=str(templates), use_package_templates=False,
+                    template_cache_dir=str(cache))
+    other.jinja_env.get_template("page.html")
+    assert len(os.listdir(cache)) == 2
+
+    # ...and a modified source is recompiled rather than read from the cache
+    (templates / "page.html").write_text("version 2")
+    fresh = Builder(template_dirs=str(templates), template_cache_dir=str(cache))
+    assert fresh.jinja_env.get_template("page.html").render() == "version 2"
+
+
+# Watch mode
+def test_watch_rebuilds_pages_affected_by_a_change(tmp_path, monkeypatch):
+    templates = tmp_path / "templates"
+    templates.mkdir()
+    (templates / "ship.html").write_text("ship {{ ship }}")
+    (templates / "other.html").write_text("other")
+    site = tmp_path / "site"
+    calls = []
+    website = make_counting_site(templates, calls)
+
+    @website.route("/other.html")
+    def other():
+        calls.append("other")
+        return render_template("other.html")
+
+    edits = iter([
+        lambda: (templates / "ship.html").write_text("vessel {{ ship }}"),
+        lambda: None,
+    ])
+    monkeypatch.setattr(flastik.flastik.time, "sleep", lambda _: next(edits)())
+
+    website.watch(rounds=2, dest=str(site))
+
+    assert calls == ["ariel", "bounty", "other", "ariel", "bounty"]
+    assert (site / "bounty" / "index.html").read_text() == "vessel bounty"
+
+
+def test_watch_refuses_archive_outputs(tmp_path):
+    website = Builder()
+    with pytest.raises(flastik.FlastikError, match="archive"):
+        website.watch(rounds=1, output=str(tmp_path / "site.zip"))
+    assert not (tmp_path / "site.zip").exists()
+
+
+# Preview server
+@pytest.fixture
+def preview(tmp_path):
+    """Serves a small web site in the background, yields a GET function."""
+    calls = []
+    website = Builder()
+    Image("logo", ICON, dest="logo.png")
+
+    @website.route("/<string:ship>/", ship=["ariel", "bounty"])
+    def ship_page(ship):
+        calls.append(ship)
+        return f"<a href='{website.url_for('home')}'>{ship}</a>"
+
+    @website.route("/index.html")
+    def home():
+        return "home"
+
+    server = website._make_server("127.0.0.1", 0, cache_size=1024)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    def get(path):
+        try:
+            with urlopen(f"http://127.0.0.1:{server.server_address[1]}{path}") as response:
+                return response.status, response.read()
+        except HTTPError as err:
+            return err.code, b""
+
+    yield get, calls, server
+    server.shutdown()
+    server.server_close()
+
+
+def test_serve_renders_pages_on_request_and_caches_them(preview):
+    get, calls, _ = preview
+
+    assert get("/bounty/") == (200, b"<a href='../index.html'>bounty</a>")
+    assert get("/") == (200, b"home")
+    assert get("/bounty/index.html")[0] == 200
+    assert calls == ["bounty"]
+    assert get("/nowhere/") == (404, b"")
+
+
+def test_serve_cache_is_bounded(preview):
+    get, calls, server = preview
+    server.pages.max_size = 40  # room for a single ship page
+
+    get("/ariel/")
+    get("/bounty/")
+    get("/ariel/")
+    assert calls == ["ariel", "bounty", "ariel"]
+    assert list(server.pages.pages) == ["ariel/index.html"]
+
+
+def test_serve_static_files_from_their_sources(preview):
+    get, _, _ = preview
+    with open(ICON, "rb") as f:
+        icon = f.read()
+
+    assert get("/images/logo.png") == (200, icon)
+    assert get("/static/favicon.ico") == (200, icon)
+    assert get("/static/css/bootstrap.min.css")[0] == 200
+    assert get("/static/../../setup.py")[0] == 404
+
+
+def test_serve_refuses_paths_outside_the_web_site(preview):
+    get, _, server = preview
+
+    assert get("/static//etc/passwd")[0] == 404
+    assert get("/static/%2Fetc%2Fhostname")[0] == 404
+    assert get("/static/css/%2E%2E/%2E%2E/__init__.py")[0] == 404
+    builder = server.builder
+    assert builder._find_static_file("static//etc/passwd") is None
+    assert builder._find_static_file("static/css/../../__init__.py") is None
+
+
+# Relative url cache
+def test_relative_urls_are_resolved_once_per_route(tmp_path):
+    website = make_numbered_site(count=3)
+    website.build(dest=str(tmp_path / "site"))
+    website.build(dest=str(tmp_path / "site"))
+
+    # home + 3 numbered pages resolved on the first build, cached on the second
+    assert website.url_cache_info() == {"hits": 4, "misses": 4, "size": 4}
+
+    @website.route("/more.html")
+    def more():
+        return ""
+
+    assert website.url_cache_info()["size"] == 0
+
+
+def test_static_file_urls_use_the_cache():
+    website = Builder()
+    image = Image("logo", ICON, dest="deep/logo.png")
+    website.current_route = "a/b/"
+
+    assert image.url == image.url == os.path.join("..", "..", "images", "deep", "logo.png")
+    assert website.url_cache_info()["hits"] == 1
+
+
+# Route registry
+def test_routes_can_be_queried_by_prefix():
+    website = Builder()
+
+    @website.route("/cruise/<int:year>/<string:ship>/", year=[2020, 2021],
+                   ship=["ariel", "bounty"])
+    def cruise(year, ship):
+        return ""
+
+    @website.route("/cruise/20210/index.html")
+    def odd_one():
+        return ""
+
+    assert website.routes.under("/cruise/2021") == [
+        os.path.join("cruise", "2021", "ariel", "index.html"),
+        os.path.join("cruise", "2021", "bounty", "index.html"),
+    ]
+    assert len(website.routes.under("cruise/")) == 5
+    assert website.routes.get(os.path.join("cruise", "2020", "ariel", "index.html"))[1] == (
+        2020, "ariel")
+
+
+def test_routes_are_resolved_without_listing_every_page():
+    website = Builder()
+
+    @website.route("/grid/<int:x>/<int:y>/", x=list(range(10_000)), y=list(range(10_000)))
+    def grid(x, y):
+        return ""
+
+    assert len(website.routes) == 100_000_000
+    assert website.routes.get(os.path.join("grid", "9999", "42", "index.html"))[1] == (9999, 42)
+    assert os.path.join("grid", "42", "10000", "index.html") not in website.routes
+    assert len(website.routes.under("grid/7")) == 10_000
+
+    with pytest.raises(flastik.FlastikError, match="already used by another view"):
+
+        @website.route("/grid/<int:a>/<int:b>/", a=[10_000, 9_999], b=[1])
+        def overlapping(a, b):
+            return ""
+
+
+
+def test_routes_whose_values_hold_the_separators_are_resolved(tmp_path):
+    website = Builder()
+
+    @website.route("/<string:ship>_<string:leg>/", ship=["sea"], leg=["leg_1", "leg_2"])
+    def leg(ship, leg):
+        return leg
+
+    route = os.path.join("sea_leg_1", "index.html")
+    assert route in website.routes
+    assert website.routes.get(route)[1] == ("sea", "leg_1")
+    assert website.routes.matching("sea_leg_*") == [route, os.path.join("sea_leg_2", "index.html")]
+
+    dest = tmp_path / "site"
+    website.build(dest=str(dest), incremental=True)
+    assert website.build(dest=str(dest), incremental=True)["removed"] == []
+    assert (dest / "sea_leg_1" / "index.html").read_text() == "leg_1"
+
+
+def test_routes_repeated_within_a_view_are_refused():
+    website = Builder()
+
+    with pytest.raises(flastik.FlastikError, match="already used by another view"):
+
+        @website.route("/<string:ship>_<string:leg>/", ship=["a", "a_b"], leg=["b_c", "c"])
+        def joined(ship, leg):
+            return ""
+
+    with pytest.raises(flastik.FlastikError, match="already used by another view"):
+
+        @website.route("/<string:ship>/<string:leg>/", ship=["a", "a/b"], leg=["b/c", "c"])
+        def nested(ship, leg):
+            return ""
+
+def test_routes_of_views_without_variables_collide_too():
+    website = Builder()
+
+    @website.route("/about/index.html")
+    def about():
+        return ""
+
+    with pytest.raises(flastik.FlastikError, match="already used by another view"):
+
+        @website.route("/about/")
+        def another_about():
+            return ""
+
+
+# Lazy route variables
+def test_route_vars_expand_on_demand_like_lists():
+    route_vars = flastik.RouteVars([[2020, 2021], {2020: ["ariel"], 2021: ["bounty", "cutty"]},
+                                    ["a", "b"]])
+    expected = [(2020, "ariel", "a"), (2020, "ariel", "b"), (2021, "bounty", "a"),
+                (2021, "bounty", "b"), (2021, "cutty", "a"), (2021, "cutty", "b")]
+    assert len(route_vars) == 6
+    assert route_vars == expected
+    assert [route_vars[i] for i in range(-6, 6)] == expected * 2
+    assert route_vars[1::2] == expected[1::2]
+    assert list(route_vars.shard(0, 4)) + list(route_vars.shard(1, 4)) == expected[0::4] + expected[1::4]
+    with pytest.raises(IndexError):
+        route_vars[6]
+
+
+def test_views_build_every_page_of_their_route_vars(tmp_path):
+    website = Builder()
+
+    @website.route("/<int:year>/<string:ship>/", year=[2020, 2021],
+                   ship={2020: ["ariel"], 2021: ["bounty", "cutty"]})
+    def cruise(year, ship):
+        return f"{year} {ship}"
+
+    route_vars = website.web_pages["cruise"]["route_vars"]
+    assert isinstance(route_vars, flastik.RouteVars)
+    assert route_vars == [(2020, "ariel"), (2021, "bounty"), (2021, "cutty")]
+    website.build(dest=str(tmp_path), jobs=2)
+    assert (tmp_path / "2021" / "cutty" / "index.html").read_text() == "2021 cutty"
+
+
+# Static file registry
+def test_static_files_are_indexed_per_builder_source_and_destination(tmp_path):
+    first = Builder()
+    Image("logo", ICON, dest="logo.png")
+    second = Builder()
+    Image("logo", ICON, dest="logo.png")  # another web site, no clash
+    Download("logo", ICON, dest="logo.png")  # another type, no clash
+    with pytest.raises(flastik.FlastikError, match="already in use"):
+        Image("logo", ICON, dest="logo.png")
+
+    storage = StaticFile.storage
+    assert len(storage) == 3
+    assert storage["builder"] == [first, second, second]
+    assert [record.type for record in storage.of(second)] == ["images", "downloads"]
+    assert len(storage.with_source(os.path.abspath(ICON), first)) == 1
+    assert second._find_static_file("downloads/logo.png") == os.path.abspath(ICON)
+    assert first._find_static_file("downloads/logo.png") is None
+
+
+# Static file deduplication
+def test_collect_static_files_hard_links_duplicated_content(tmp_path):
+    (tmp_path / "a.bin").write_bytes(b"same" * 1000)
+    (tmp_path / "b.bin").write_bytes(b"same" * 1000)
+    (tmp_path / "c.bin").write_bytes(b"diff" * 1000)
+    Builder()
+    Download("a", str(tmp_path / "a.bin"))
+    Download("b", str(tmp_path / "b.bin"))
+    Download("c", str(tmp_path / "c.bin"))
+    Image("a", str(tmp_path / "a.bin"))
+
+    site = tmp_path / "site"
+    collect_static_files(static_root=str(site), copy_locally=True, dedupe=True)
+
+    first = os.stat(site / "downloads" / "a.bin")
+    assert os.stat(site / "downloads" / "b.bin").st_ino == first.st_ino
+    assert os.stat(site / "images" / "a.bin").st_ino == first.st_ino
+    assert os.stat(site / "downloads" / "c.bin").st_ino != first.st_ino
+    assert (site / "downloads" / "b.bin").read_bytes() == b"same" * 1000
+
+
+def test_collect_static_files_hard_links_a_source_used_twice(tmp_path):
+    (tmp_path / "a.bin").write_bytes(b"unique size")
+    Builder()
+    Image("a", str(tmp_path / "a.bin"))
+    Download("a", str(tmp_path / "a.bin"))
+
+    site = tmp_path / "site"
+    collect_static_files(static_root=str(site), copy_locally=True, dedupe=True)
+
+    first = os.stat(site / "images" / "a.bin")
+    assert os.stat(site / "downloads" / "a.bin").st_ino == first.st_ino
+
+
+# Static collection engine
+def test_collect_static_files_skips_unchanged_files(tmp_path):
+    source = tmp_path / "a.bin"
+    source.write_bytes(b"first")
+    Builder()
+    Download("a", str(source))
+    site = tmp_path / "site"
+    collect_static_files(static_root=str(site), copy_locally=True, file_umask=0o640)
+    deployed = site / "downloads" / "a.bin"
+    inode = os.stat(deployed).st_ino
+    assert oct(os.stat(deployed).st_mode & 0o777) == oct(0o640)
+
+    collect_static_files(static_root=str(site), copy_locally=True, file_umask=0o640)
+    assert os.stat(deployed).st_ino == inode
+
+    source.write_bytes(b"second")
+    collect_static_files(static_root=str(site), copy_locally=True, file_umask=0o640)
+    assert deployed.read_bytes() == b"second"
+    assert [path.name for path in deployed.parent.iterdir()] == ["a.bin"]
+
+
+def test_collect_static_files_can_hard_link_sources(tmp_path):
+    source = tmp_path / "a.bin"
+    source.write_bytes(b"content")
+    Builder()
+    Download("a", str(source))
+    site = tmp_path / "site"
+    collect_static_files(static_root=str(site), hard_link=True)
+    deployed = site / "downloads" / "a.bin"
+    assert not deployed.is_symlink()
+    assert os.path.samefile(deployed, source)
+
+
+# Static sync
+def test_rebuilds_only_rewrite_static_files_which_changed(tmp_path):
+    css = tmp_path / "style.css"
+    css.write_text("body {}")
+    website = Builder(css_style_sheet=str(css))
+
+    @website.route("/")
+    def index():
+        return ""
+
+    dest = tmp_path / "site"
+    website.build(dest=str(dest), static_umask=0o640)
+    static = dest / "static"
+    bootstrap = static / "css" / "bootstrap.min.css"
+    signature = os.stat(bootstrap).st_mtime_ns, os.stat(bootstrap).st_ino
+    assert oct(os.stat(bootstrap).st_mode & 0o777) == oct(0o640)
+    (static / "css" / "stale.css").write_text("")
+
+    css.write_text("body {margin: 0}")
+    website.build(dest=str(dest), static_umask=0o640)
+    assert (os.stat(bootstrap).st_mtime_ns, os.stat(bootstrap).st_ino) == signature
+    assert (static / "stylesheet.css").read_text() == "body {margin: 0}"
+    assert not (static / "css" / "stale.css").exists()
+
+
+# File system layer
+def test_pages_and_folders_are_made_with_their_modes(tmp_path):
+    website = Builder()
+
+    @website.route("/a/b/")
+    def page():
+        return "page"
+
+    dest = tmp_path / "site"
+    dest.mkdir()
+    (dest / "a").mkdir()
+    (dest / "a" / "b").mkdir()
+    (dest / "a" / "b" / "index.html").write_text("old")
+    os.chmod(dest / "a" / "b" / "index.html", 0o600)
+    previous_umask = os.umask(0o077)
+    try:
+        website.build(dest=str(dest), html_umask=0o644, dir_umask=0o755)
+    finally:
+        os.umask(previous_umask)
+
+    assert oct(os.stat(dest / "a" / "b" / "index.html").st_mode & 0o777) == oct(0o644)
+    assert (dest / "a" / "b" / "index.html").read_text() == "page"
+    assert oct(os.stat(dest / "static").st_mode & 0o777) == oct(0o755)
+    assert oct(os.stat(dest / "static" / "css").st_mode & 0o777) == oct(0o755)
+
+
+# Build report
+def test_build_report_times_each_view(tmp_path):
+    website = Builder()
+
+    @website.route("/<int:number>/", number=[1, 2, 3])
+    def numbered(number):
+        return "x" * number
+
+    @website.route("/about/")
+    def about():
+        return "about"
+
+    report = tmp_path / "report.json"
+    website.build(dest=str(tmp_path / "site"), report=str(report), report_slowest=2)
+
+    summary = json.loads(report.read_text())
+    assert summary["pages"] == 4
+    assert summary["views"]["numbered"]["pages"] == 3
+    assert summary["views"]["numbered"]["bytes_written"] == 6
+    assert set(summary["views"]["about"]["render_seconds"]) == {"total", "mean", "p95"}
+    assert len(summary["slowest_pages"]) == 2
+    assert {"view", "route_vars", "page", "render_seconds"} == set(summary["slowest_pages"][0])
+    prom = (tmp_path / "report.prom").read_text()
+    assert 'flastik_view_pages{view="numbered"} 3' in prom
+    assert "flastik_build_seconds " in prom
+    assert "# TYPE flastik_view_render_seconds gauge" in prom
+    assert "_total" not in prom
+
+
+def test_build_report_counts_the_bytes_of_changed_pages_only(tmp_path):
+    website = Builder()
+
+    @website.route("/<int:number>/", number=[1, 2, 3])
+    def numbered(number):
+        return "x" * 5000
+
+    @website.route("/streamed/")
+    def streamed():
+        return iter(["x"] * 5000)
+
+    report = tmp_path / "report.json"
+    website.build(dest=str(tmp_path / "site"), report=str(report), jobs=1)
+    assert json.loads(report.read_text())["views"]["numbered"]["bytes_written"] == 15000
+    changes = website.build(dest=str(tmp_path / "site"), report=str(report), jobs=1)
+    assert changes["added"] == changes["modified"] == []
+    views = json.loads(report.read_text())["views"]
+    assert views["numbered"]["bytes_written"] == views["streamed"]["bytes_written"] == 0
+
+
+# RST cache
+def test_rst_conversions_are_cached_on_disk_and_compiled_once(tmp_path, monkeypatch):
+    rst = tmp_path / "page.rst"
+    rst.write_text("Title\n=====\n\nHello {{ name }}\n")
+    cache = tmp_path / "cache"
+    Builder(rst_cache_dir=str(cache))
+    assert "Hello Ann" in flastik.rst2html(str(rst), name="Ann")
+    assert len(list(cache.iterdir())) == 1
+
+    conversions = []
+    original = flastik.flastik.publish_parts
+
+    def counting_publish_parts(*args, **kwargs):
+        conversions.append(args)
+        return original(*args, **kwargs)
+
+    monkeypatch.setattr(flastik.flastik, "publish_parts", counting_publish_parts)
+    website = Builder(rst_cache_dir=str(cache))
+    assert "Hello Bob" in flastik.rst2html(str(rst), name="Bob")
+    assert "Hello Cid" in flastik.rst2html(str(rst), name="Cid")
+    assert conversions == []
+    assert len(website._rst_templates) == 1
+
+    rst.write_text("Title\n=====\n\nBye {{ name }}\n")
+    assert "Bye Dee" in flastik.rst2html(str(rst), name="Dee")
+    assert len(conversions) == 1
+
+
+def test_preload_rst_converts_a_folder_ahead_of_rendering(tmp_path, monkeypatch):
+    for i in range(3):
+        (tmp_path / f"page_{i}.rst").write_text(f"Page {i}\n======\n\nHello {{{{ name }}}}\n")
+    (tmp_path / "other.txt").write_text("not RST")
+    website = Builder()
+    assert website.preload_rst(str(tmp_path), jobs=2) == 3
+    assert website.preload_rst(str(tmp_path), jobs=2) == 0
+
+    def no_conversion(*args, **kwargs):
+        raise AssertionError("RST converted again")
+
+    monkeypatch.setattr(flastik.flastik, "publish_parts", no_conversion)
+    assert "Hello Ann" in flastik.rst2html(str(tmp_path / "page_2.rst"), name="Ann")
+
+
+def test_preload_rst_converts_serially_without_fork(tmp_path, monkeypatch):
+    for i in range(3):
+        (tmp_path / f"page_{i}.rst").write_text(f"Page {i}\n======\n\nHello\n")
+    def get_context(method=None):
+        raise ValueError(f"cannot find context for {method!r}")
+
+    monkeypatch.setattr(
+        flastik.flastik.multiprocessing, "get_all_start_methods", lambda: ["spawn"]
+    )
+    monkeypatch.setattr(flastik.flastik.multiprocessing, "get_context", get_context)
+    website = Builder()
+    assert website.preload_rst(str(tmp_path), jobs=2) == 3
+    assert len(website._rst_html) == 3
+
+
+def test_preloaded_rst_conversions_outlast_the_memory_bound(tmp_path, monkeypatch):
+    monkeypatch.setattr(Builder, "rst_cache_max_size", 2)
+    for i in range(5):
+        (tmp_path / f"page_{i}.rst").write_text(f"Page {i}\n======\n\nHello {{{{ name }}}}\n")
+    website = Builder()
+    assert website.preload_rst(str(tmp_path), jobs=1) == 5
+
+    def no_conversion(*args, **kwargs):
+        raise AssertionError("RST converted again")
+
+    monkeypatch.setattr(flastik.flastik, "publish_parts", no_conversion)
+    for i in range(5):
+        assert f"Page {i}" in flastik.rst2html(str(tmp_path / f"page_{i}.rst"), name="Ann")
+
+
+def test_rst_conversions_kept_in_memory_are_bounded(tmp_path, monkeypatch):
+    monkeypatch.setattr(Builder, "rst_cache_max_size", 2)
+    website = Builder()
+    for i in range(5):
+        rst = tmp_path / f"page_{i}.rst"
+        rst.write_text(f"Page {i}\n======\n\nHello {{{{ name }}}}\n")
+        assert f"Page {i}" in flastik.rst2html(str(rst), name="Ann")
+    assert len(website._rst_html) == 2
+    assert len(website._rst_templates) == 2
+
+
+# Streaming render
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_streamed_pages_match_rendered_ones(tmp_path, jobs):
+    templates = tmp_path / "templates"
+    templates.mkdir()
+    (templates / "table.html").write_text(
+        '<a href="{{ url_for("table", kind="a") }}">a</a>'
+        "{% for row in rows %}<tr><td>{{ row }}</td></tr>{% endfor %}")
+    website = Builder(template_dirs=[str(templates)])
+
+    @website.route("/<string:kind>/", kind=["streamed", "rendered"])
+    def table(kind):
+        render = flastik.stream_template if kind == "streamed" else flastik.render_template
+        return render("table.html", rows=range(5000))
+
+    dest = tmp_path / "site"
+    website.build(dest=str(dest), jobs=jobs)
+    streamed = (dest / "streamed" / "index.html").read_text()
+    assert streamed == (dest / "rendered" / "index.html").read_text()
+    assert streamed.startswith('<a href="../a/index.html">')
+    assert website.dependencies(str(templates / "table.html")) == [
+        os.path.join("rendered", "index.html"), os.path.join("streamed", "index.html")]
+
+
+
+def test_failing_streams_leave_no_partial_page(tmp_path):
+    website = Builder()
+    fail = []
+
+    @website.route("/<string:kind>/", kind=["new", "old"])
+    def page(kind):
+        yield f"<p>{kind}</p>"
+        if kind in fail:
+            raise RuntimeError("render failed")
+        yield "<p>end</p>"
+
+    dest = tmp_path / "site"
+    website.build(dest=str(dest), jobs=1)
+    (dest / "new" / "index.html").unlink()
+    fail[:] = ["new"]
+    with pytest.raises(RuntimeError, match="render failed"):
+        website.build(dest=str(dest), jobs=1)
+    assert os.listdir(dest / "new") == []
+    fail[:] = ["old"]
+    with pytest.raises(RuntimeError, match="render failed"):
+        website.build(dest=str(dest), jobs=1)
+    assert os.listdir(dest / "old") == ["index.html"]
+    assert (dest / "old" / "index.html").read_text() == "<p>old</p><p>end</p>"
+
+
+# Minification
+def test_minified_pages_keep_preformatted_text(tmp_path):
+    css = tmp_path / "style.css"
+    css.write_text("/* theme */\nbody  {\n  margin: 0;\n  font: 'A  B';\n}\n")
+    website = Builder(css_style_sheet=str(css))
+    html = ("<html>\n  <!-- nav -->\n  <body>   <p>a   b</p>\n"
+            "    <pre>  keep\n      this </pre><textarea>  as  is </textarea>\n</body></html>")
+
+    @website.route("/")
+    def index():
+        return html
+
+    dest = tmp_path / "site"
+    website.build(dest=str(dest), minify=True)
+    assert (dest / "index.html").read_text() == (
+        "<html>\n<body> <p>a b</p>\n<pre>  keep\n      this </pre>"
+        "<textarea>  as  is </textarea>\n</body></html>")
+    assert (dest / "static" / "stylesheet.css").read_text() == "body{margin:0;font:'A  B'}"
+
+
+def test_minified_comments_do_not_glue_words():
+    assert _minify_html("word<!-- c --> next") == "word next"
+    assert _minify_html("word <!-- a -->\n<!-- b -->next") == "word\nnext"
+    assert _minify_html("word<!-- c -->next") == "wordnext"
+    assert _minify_html("a <!--[if IE]>b<![endif]--> c") == "a <!--[if IE]>b<![endif]--> c"
+
+
+def test_minified_style_sheets_keep_selector_combinators():
+    assert _minify_css("a :hover {\n  color : red ;\n}") == "a :hover{color:red}"
+    assert _minify_css("a::before{content : ':'}") == "a::before{content:':'}"
+
+
+def test_unchanged_pages_are_not_minified_again(tmp_path, monkeypatch):
+    website = Builder()
+
+    @website.route("/<int:number>/", number=[1, 2])
+    def page(number):
+        return f"<p>  {number}  </p>"
+
+    dest = tmp_path / "site"
+    website.build(dest=str(dest), minify=True, incremental=True)
+    minified = []
+    original = flastik.flastik._minify_html
+    monkeypatch.setattr(flastik.flastik, "_minify_html",
+                        lambda html: minified.append(html) or original(html))
+    website.meta["unused"] = "by the views"  # every page is rendered again
+    website.build(dest=str(dest), minify=True, incremental=True)
+    assert minified == []
+    assert (dest / "2" / "index.html").read_text() == "<p> 2 </p>"
+
+
+# Precompression
+def test_precompressed_copies_are_only_made_when_worth_it(tmp_path, monkeypatch):
+    website = Builder()
+
+    @website.route("/<string:size>/", size=["small", "large"])
+    def page(size):
+        return "<p>tiny</p>" if size == "small" else "<p>row</p>\n" * 1000
+
+    dest = tmp_path / "site"
+    website.build(dest=str(dest), precompress=True)
+    large = dest / "large" / "index.html"
+    assert gzip.decompress((dest / "large" / "index.html.gz").read_bytes()) == large.read_bytes()
+    assert not (dest / "small" / "index.html.gz").exists()
+    assert (dest / "static" / "css" / "bootstrap.min.css.gz").is_file()
+    assert not list((dest / "static").glob("*.ico.gz"))
+
+    compressed = []
+    gzip_file = flastik.flastik._gzip_file
+
+    def spy(path, min_size):
+        if gzip_file(path, min_size):
+            compressed.append(path)
+            return True
+        return False
+
+    monkeypatch.setattr(flastik.flastik, "_gzip_file", spy)
+    assert website.build(dest=str(dest), precompress=True)["removed"] == []
+    assert (dest / "static" / "css" / "bootstrap.min.css.gz").is_file()
+    assert compressed == []  # unchanged, not compressed again
+
+
+# Archive output
+@pytest.mark.parametrize("archive", ["site.zip", "site.tar.gz"])
+def test_build_streams_the_web_site_into_an_archive(tmp_path, archive):
+    import tarfile
+    import zipfile
+
+    website = Builder()
+    Image("logo", ICON, dest="logo.png")
+
+    @website.route("/<string:page>/", page=["a", "b"])
+    def page(page):
+        return f"<p>{page}</p>"
+
+    dest = tmp_path / "site"
+    output = tmp_path / archive
+    website.build(dest=str(dest), output=str(output), jobs=2, html_umask="600")
+    assert not dest.exists()
+
+    if archive.endswith(".zip"):
+        with zipfile.ZipFile(output) as f:
+            modes = {i.filename.rstrip("/"): i.external_attr >> 16 & 0o777 for i in f.infolist()}
+            content = f.read("a/index.html")
+            logo = f.read("images/logo.png")
+    else:
+        with tarfile.open(output) as f:
+            modes = {i.name: i.mode for i in f.getmembers()}
+            content = f.extractfile("a/index.html").read()
+            logo = f.extractfile("images/logo.png").read()
+    assert content == b"<p>a</p>"
+    with open(ICON, "rb") as f:
+        assert logo == f.read()
+    assert modes["a"] == modes["static"] == 0o755
+    assert modes["a/index.html"] == modes["b/index.html"] == 0o600
+    assert modes["static/favicon.ico"] == 0o655
+    assert modes["images/logo.png"] == 0o644
+    assert "static/css/bootstrap.min.css" in modes
+
+
+def test_failed_archive_builds_leave_no_archive(tmp_path):
+    website = Builder()
+
+    @website.route("/")
+    def index():
+        raise ValueError("boom")
+
+    output = tmp_path / "site.tar"
+    with pytest.raises(ValueError):
+        website.build(dest=str(tmp_path / "site"), output=str(output))
+    assert not output.exists()
+    with pytest.raises(flastik.FlastikError, match="Unsupported archive"):
+        website.build(output=str(tmp_path / "site.rar"))
+
+
+# Change set
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_builds_only_touch_and_report_changed_files(tmp_path, jobs):
+    templates = tmp_path / "templates"
+    templates.mkdir()
+    (templates / "page.html").write_text("<p>{{ text }}</p>")
+    website = Builder(template_dirs=[str(templates)])
+    texts = {"a": "first", "b": "second", "c": "third"}
+
+    @website.route("/<string:page>/", page=["a", "b"])
+    def page(page):
+        render = flastik.stream_template if page == "b" else render_template
+        return render("page.html", text=texts[page])
+
+    dest = tmp_path / "site"
+    changes = website.build(dest=str(dest), jobs=jobs)
+    assert {"a/index.html", "b/index.html", "static/stylesheet.css"} <= set(changes["added"])
+    assert changes["modified"] == changes["removed"] == []
+
+    pages = [dest / "a" / "index.html", dest / "b" / "index.html"]
+    mtimes = [os.stat(page).st_mtime_ns for page in pages]
+    assert website.build(dest=str(dest), jobs=jobs) == {
+        "added": [], "modified": [], "removed": []}
+    assert [os.stat(page).st_mtime_ns for page in pages] == mtimes
+    assert sorted(os.listdir(dest / "b")) == ["index.html"]  # no stream left over
+
+    texts.update(a="changed", b="changed too")
+
+    @website.route("/c/")
+    def other():
+        return "<p>new</p>"
+
+    change_set = tmp_path / "changes.json"
+    website.build(dest=str(dest), jobs=jobs, change_set=str(change_set))
+    assert json.loads(change_set.read_text()) == {
+        "added": ["c/index.html"],
+        "modified": ["a/index.html", "b/index.html"],
+        "removed": [],
+    }
+
+
+# Route subsets
+def test_route_vars_where_walks_the_matching_branches_only():
+    route_vars = flastik.RouteVars(
+        [[2020, 2021], {2020: ["a", "b"], 2021: ["c"]}, ["x", "y"]]
+    )
+    positions = list(route_vars.where([2021]))
+    assert [route_vars[i] for i in positions] == [(2021, "c", "x"), (2021, "c", "y")]
+    assert list(route_vars.where(None, None, ["y"])) == [1, 3, 5]
+    assert list(route_vars[1::2].where(["2020"])) == [0, 1]  # str. values, as in urls
+    assert list(route_vars.where(None, [])) == []
+
+
+def test_builds_can_be_restricted_to_routes_and_variable_values(tmp_path):
+    website = Builder()
+    rendered = []
+
+    @website.route(
+        "/cruise/<int:year>/<string:leg>/",
+        year=[2020, 2021],
+        leg={2020: ["a", "b"], 2021: ["c", "d"]},
+    )
+    def cruise(year, leg):
+        rendered.append((year, leg))
+        return f'<a href="{website.url_for("cruise", year=2020, leg="a")}">{leg}</a>'
+
+    @website.route("/")
+    def index():
+        rendered.append("index")
+        return "index"
+
+    dest = tmp_path / "site"
+    website.build(dest=str(dest), routes=["cruise/2021/*"])
+    assert rendered == [(2021, "c"), (2021, "d")]
+    assert (dest / "cruise" / "2021" / "d" / "index.html").read_text() == (
+        '<a href="../../2020/a/index.html">d</a>')
+    assert not (dest / "cruise" / "2020").exists()
+
+    rendered.clear()
+    website.build(dest=str(dest), where={"leg": ["b", "c"]})
+    assert rendered == [(2020, "b"), (2021, "c")]
+    rendered.clear()
+    website.build(dest=str(dest), routes=["cruise/*/c", ""], where=["year=2021"])
+    assert rendered == [(2021, "c")]
+    with pytest.raises(flastik.FlastikError, match="ship"):
+        website.build(dest=str(dest), where={"ship": ["x"]})
+
+    rendered.clear()
+    website.build(dest=str(dest), where={"leg": []})
+    website.build(dest=str(dest), routes=["cruise/*/*"], where={"leg": []})
+    assert rendered == []
+    with pytest.raises(flastik.FlastikError, match="name=value"):
+        website.build(dest=str(dest), where=["year"])